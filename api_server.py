@@ -0,0 +1,50 @@
+"""Read-only HTTP/JSON access to the 'transactions' table, served straight from SQLite."""
+import sqlite3
+from sinks import EXPORT_COLUMNS
+from settings import logger
+
+MAX_PAGE_SIZE = 1000
+_SELECT = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM transactions"
+
+
+def open_readonly(sqlite_path: str) -> sqlite3.Connection:
+    """Read-only connection; with WAL it reads the last committed state while the worker keeps writing."""
+    conn = sqlite3.connect(f'file:{sqlite_path}?mode=ro', uri=True, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+async def start_api_server(host: str, port: int, sqlite_path: str):
+    """Serves GET /accounts (paged by ?offset=&limit=) and GET /accounts/{name}; returns the aiohttp runner to clean up on shutdown."""
+    from aiohttp import web
+
+    conn = open_readonly(sqlite_path)
+
+    async def handle_account(request: web.Request) -> web.Response:
+        # name is UNIQUE, so this is an index lookup
+        row = conn.execute(f"{_SELECT} WHERE name = ?", (request.match_info['name'],)).fetchone()
+        if row is None:
+            raise web.HTTPNotFound(text='{"error": "account not found"}', content_type='application/json')
+        return web.json_response(dict(row))
+
+    async def handle_accounts(request: web.Request) -> web.Response:
+        try:
+            offset = max(0, int(request.query.get('offset', 0)))
+            limit = min(MAX_PAGE_SIZE, max(1, int(request.query.get('limit', 100))))
+        except ValueError:
+            raise web.HTTPBadRequest(text='{"error": "offset and limit must be integers"}', content_type='application/json')
+        rows = conn.execute(f"{_SELECT} ORDER BY id LIMIT ? OFFSET ?", (limit, offset)).fetchall()
+        return web.json_response({'accounts': [dict(row) for row in rows], 'offset': offset, 'limit': limit})
+
+    async def close(app: web.Application):
+        conn.close()
+
+    app = web.Application()
+    app.router.add_get('/accounts', handle_accounts)
+    app.router.add_get('/accounts/{name}', handle_account)
+    app.on_cleanup.append(close)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f'[API] Serving on http://{host}:{port}/accounts')
+    return runner
@@ -1,27 +1,165 @@
 import asyncio
+import multiprocessing
 import time
-from settings import settings, logger
+from typing import Optional
+from settings import configure_logging, get_settings, logger
 from service_adapter import ServiceUpdater, ServiceReader
 from sqlite_adapter import SQLiteAdapter
 from service_worker import ServiceWorker
-from target_parser import TargetParser 
-from utils import sqlite_conn_context
+from shard_merger import ShardMerger
+from target_parser import TargetParser
+from http_cache import HttpCache
+from json_codec import JsonDecoder
+from utils import sqlite_conn_context, shard_path
+from metrics import start_metrics_server
+from api_server import start_api_server
+from sinks import FileSink, OutputSink
+from tracing import CycleProfiler
+import tracing
 
-if __name__ == "__main__":
-    with sqlite_conn_context(settings.sqlite_path) as sqlite_conn:
-        logger.info('[Initialization] Started')
-        service_reader = ServiceReader(settings.service_account_file,
-                                       settings.scopes,
-                                       settings.read_sheet_name,
-                                       settings.read_worksheet_name,
-                                       headers=('accounts','claim_period'))
-        service_updater = ServiceUpdater(settings.service_account_file,
-                                         settings.scopes,
-                                         settings.write_sheet_name,
-                                         settings.write_worksheet_name,
-                                         headers=('name', 'hash', 'quantity', 'near_amount', 'hot_amount', 'age', 'claim_period'))
+
+def build_reader() -> ServiceReader:
+    settings = get_settings()
+    return ServiceReader(settings.service_account_file,
+                         settings.scopes,
+                         settings.read_sheet_name,
+                         settings.read_worksheet_name,
+                         headers=('accounts','claim_period'),
+                         sheet_key=settings.read_sheet_key)
+
+
+def build_updater() -> ServiceUpdater:
+    settings = get_settings()
+    return ServiceUpdater(settings.service_account_file,
+                          settings.scopes,
+                          settings.write_sheet_name,
+                          settings.write_worksheet_name,
+                          headers=('name', 'hash', 'quantity', 'near_amount', 'hot_amount', 'age', 'claim_period'),
+                          sheet_key=settings.write_sheet_key)
+
+
+def build_sinks(sqlite_adapter: SQLiteAdapter) -> list[OutputSink]:
+    """Outputs besides the sheet, for the process that publishes."""
+    settings = get_settings()
+    sinks = []
+    if settings.output_file_path:
+        sinks.append(FileSink(sqlite_adapter, settings.output_file_path, interval=settings.output_file_interval))
+    return sinks
+
+
+def configure_tracing(shard_index: Optional[int] = None):
+    settings = get_settings()
+    if settings.trace_path:
+        tracing.configure(shard_path(settings.trace_path, shard_index) if shard_index is not None else settings.trace_path,
+                          settings.trace_accounts)
+
+
+def build_worker(sqlite_conn, service_updater: Optional[ServiceUpdater], shard: Optional[tuple[int, int]] = None) -> ServiceWorker:
+    settings = get_settings()
+    # Shards spread over the available nearblocks API keys
+    api_key = settings.api_keys[(shard[0] if shard else 0) % len(settings.api_keys)] if settings.api_keys else None
+    sqlite_adapter = SQLiteAdapter(sqlite_conn, settings.db_schemas, settings.db_recordset_size)
+    cache_path = settings.http_cache_path and (shard_path(settings.http_cache_path, shard[0]) if shard else settings.http_cache_path)
+    http_cache = HttpCache(settings.http_cache_ttls, settings.http_cache_size, cache_path or None)
+    target_parser = TargetParser(settings.base_urls,
+                                 parsing_depth=settings.parsing_depth,
+                                 requests_per_second=settings.requests_per_second,
+                                 connection_limit=settings.connection_limit,
+                                 max_retries=settings.max_retries,
+                                 backoff_base=settings.backoff_base,
+                                 backoff_max=settings.backoff_max,
+                                 scan_order=settings.scan_order,
+                                 prefetch_pages=settings.prefetch_pages,
+                                 per_page=settings.per_page,
+                                 api_key=api_key,
+                                 http_cache=http_cache,
+                                 decoder=JsonDecoder(settings.json_backend))
+    return ServiceWorker(target_parser, service_updater, build_reader(), sqlite_adapter,
+                         settings.timeout, concurrency=settings.concurrency,
+                         incremental=settings.incremental_sync,
+                         queue_size=settings.queue_size,
+                         sheet_sync_interval=settings.sheet_sync_interval,
+                         shard=shard,
+                         ingest_mode=settings.ingest_mode,
+                         feed_per_page=settings.feed_per_page,
+                         feed_max_pages=settings.feed_max_pages,
+                         feed_full_refresh_interval=settings.feed_full_refresh_interval,
+                         account_retries=settings.account_retries,
+                         resume_delay=settings.resume_delay,
+                         scheduling=settings.scheduling,
+                         schedule_tick=settings.schedule_tick,
+                         schedule_batch=settings.schedule_batch,
+                         refresh_min_interval=settings.refresh_min_interval,
+                         refresh_max_interval=settings.refresh_max_interval,
+                         refresh_factor=settings.refresh_factor,
+                         # Shards leave every output to the merger
+                         sinks=build_sinks(sqlite_adapter) if service_updater is not None else None,
+                         sheet_publish_interval=settings.sheet_publish_interval,
+                         profiler=CycleProfiler(settings.profiler, settings.profile_dir) if settings.profiler else None)
+
+
+async def main(runner, shard_index: Optional[int] = None):
+    """Runs `runner` alongside the metrics endpoint; the API is served by the process that owns the published database."""
+    settings = get_settings()
+    # Each shard process serves its own metrics next to the merger's port
+    metrics_port = settings.metrics_port + shard_index + 1 if settings.metrics_port and shard_index is not None else settings.metrics_port
+    metrics_runner = await start_metrics_server(settings.metrics_host, metrics_port) if metrics_port else None
+    api_runner = None
+    if settings.api_port and shard_index is None:
+        api_runner = await start_api_server(settings.api_host, settings.api_port, settings.sqlite_path)
+    try:
+        await runner.run()
+    finally:
+        for web_runner in (api_runner, metrics_runner):
+            if web_runner is not None:
+                await web_runner.cleanup()
+
+
+def run_shard(index: int):
+    """Runs the worker of one shard: it fills its own SQLite file and leaves publishing to the merger."""
+    settings = get_settings()
+    # A log file per shard, as RotatingFileHandler cannot share one file between processes
+    configure_logging(settings, shard_path(settings.log_path, index))
+    with sqlite_conn_context(shard_path(settings.sqlite_path, index), settings.sqlite_synchronous) as sqlite_conn:
+        logger.info(f'[Initialization] Shard {index}/{settings.shard_count} started')
+        configure_tracing(index)
+        service_worker = build_worker(sqlite_conn, None, shard=(index, settings.shard_count))
+        asyncio.run(main(service_worker, shard_index=index))
+
+
+def run_merger(shard_processes: Optional[list[multiprocessing.Process]] = None):
+    settings = get_settings()
+    with sqlite_conn_context(settings.sqlite_path, settings.sqlite_synchronous) as sqlite_conn:
+        logger.info('[Initialization] Merger started')
+        configure_tracing()
         sqlite_adapter = SQLiteAdapter(sqlite_conn, settings.db_schemas, settings.db_recordset_size)
-        target_parser = TargetParser(settings.base_urls, parsing_depth=settings.parsing_depth)
-        service_worker = ServiceWorker(target_parser, service_updater, service_reader, sqlite_adapter, settings.timeout)
-        logger.info('[Initialization] Done')
-        asyncio.run(service_worker.run())
\ No newline at end of file
+        shard_merger = ShardMerger(build_updater(), build_reader(), sqlite_adapter,
+                                   [shard_path(settings.sqlite_path, index) for index in range(settings.shard_count)],
+                                   merge_interval=settings.merge_interval,
+                                   sinks=build_sinks(sqlite_adapter),
+                                   sheet_publish_interval=settings.sheet_publish_interval,
+                                   shard_processes=shard_processes)
+        asyncio.run(main(shard_merger))
+
+
+if __name__ == "__main__":
+    settings = get_settings()
+    if settings.shard_count > 1 and settings.shard_role == 'shard':
+        # One shard per deployment, SHARD_INDEX tells which
+        run_shard(settings.shard_index)
+    elif settings.shard_count > 1 and settings.shard_role == 'merger':
+        run_merger()
+    elif settings.shard_count > 1:
+        shards = [multiprocessing.Process(target=run_shard, args=(index,), name=f'shard-{index}', daemon=True)
+                  for index in range(settings.shard_count)]
+        for shard in shards:
+            shard.start()
+        # The merger exits once a shard dies, so that the whole container is restarted
+        run_merger(shards)
+    else:
+        with sqlite_conn_context(settings.sqlite_path, settings.sqlite_synchronous) as sqlite_conn:
+            logger.info('[Initialization] Started')
+            configure_tracing()
+            service_worker = build_worker(sqlite_conn, build_updater())
+            logger.info('[Initialization] Done')
+            asyncio.run(main(service_worker))
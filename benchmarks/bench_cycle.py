@@ -0,0 +1,215 @@
+"""End-to-end cycle benchmark against local nearblocks and Sheets stand-ins.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_cycle --accounts 100 1000 10000
+
+Every scenario runs in a fresh process so that peak RSS is its own.
+
+With --cancel-after N the first cycle is cancelled once N accounts have
+been requested and then resumed; the run exits with status 1 unless the
+resumed cycle requests exactly the accounts that were still outstanding.
+
+With --check-sheet-recovery one values.batchUpdate of the output sheet
+fails while accounts are added, and accounts are removed in the next
+cycle; the run exits with status 1 unless the output sheet then holds
+exactly the rows of SQLite, in the same order.
+"""
+import argparse
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from typing import Any
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Settings are read from the environment on first use
+BENCH_ENV = {
+    'SERVICE_ACCOUNT_FILE': 'bench-service-account.json',
+    'LOG_PATH': os.path.join(tempfile.gettempdir(), 'bc-parser-bench.log'),
+    'LOG_LEVEL': 'WARNING',
+    'SQLITE_PATH': ':memory:',
+    'READ_SHEET_NAME': 'bench-read',
+    'READ_WORKSHEET_NAME': 'accounts',
+    'WRITE_SHEET_NAME': 'bench-write',
+    'WRITE_WORKSHEET_NAME': 'transactions',
+    'PARSING_DEPTH': '3',
+    'DB_RECORDSET_SIZE': '500',
+    'TIMEOUT': '0',
+}
+
+
+def run_scenario(options: dict[str, Any]) -> dict[str, Any]:
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+
+    import service_auth
+    from benchmarks.fake_nearblocks import FakeNearblocks
+    from benchmarks.fake_sheets import FakeServiceAuth, FakeWorksheet
+    from http_cache import HttpCache
+    from json_codec import JsonDecoder
+    from service_adapter import ServiceReader, ServiceUpdater
+    from service_worker import ServiceWorker
+    from settings import settings
+    from sqlite_adapter import SQLiteAdapter
+    from target_parser import TargetParser
+    from tracing import CycleProfiler
+    import tracing
+    from utils import sqlite_conn_context
+
+    service_auth.ServiceAuth = FakeServiceAuth
+    read_key = (settings.read_sheet_name, settings.read_worksheet_name)
+    write_key = (settings.write_sheet_name, settings.write_worksheet_name)
+    read_sheet = FakeServiceAuth.worksheets[read_key] = FakeWorksheet(
+        [['accounts', 'claim_period']] + [[f'bench{i}.tg', '24'] for i in range(options['accounts'])])
+    FakeServiceAuth.worksheets[write_key] = FakeWorksheet()
+
+    if options['trace_path']:
+        tracing.configure(options['trace_path'])
+
+    async def main() -> dict[str, Any]:
+        async with FakeNearblocks(latency=options['latency'], pages=options['pages'],
+                                  error_rate=options['error_rate'], retry_after=options['retry_after']) as nearblocks:
+            with sqlite_conn_context(settings.sqlite_path) as sqlite_conn:
+                service_reader = ServiceReader(settings.service_account_file, settings.scopes,
+                                               settings.read_sheet_name, settings.read_worksheet_name,
+                                               headers=('accounts', 'claim_period'))
+                service_updater = ServiceUpdater(settings.service_account_file, settings.scopes,
+                                                 settings.write_sheet_name, settings.write_worksheet_name,
+                                                 headers=('name', 'hash', 'quantity', 'near_amount', 'hot_amount', 'age', 'claim_period'))
+                sqlite_adapter = SQLiteAdapter(sqlite_conn, settings.db_schemas, settings.db_recordset_size)
+                target_parser = TargetParser(nearblocks.base_urls,
+                                             parsing_depth=options['pages'],
+                                             scan_order=options['scan_order'],
+                                             requests_per_second=options['rps'],
+                                             connection_limit=options['concurrency'],
+                                             backoff_base=0.05,
+                                             decoder=JsonDecoder(options['json_backend']),
+                                             http_cache=HttpCache({'account': options['http_cache_ttl'],
+                                                                   'inventory': options['http_cache_ttl']}))
+                service_worker = ServiceWorker(target_parser, service_updater, service_reader, sqlite_adapter,
+                                               concurrency=options['concurrency'],
+                                               sheet_sync_interval=options['sheet_sync_interval'],
+                                               ingest_mode=options['ingest_mode'],
+                                               scheduling=options['scheduling'],
+                                               profiler=CycleProfiler(options['profiler'], options['profile_dir']) if options['profiler'] else None)
+                write_sheet = FakeServiceAuth.worksheets[write_key]
+
+                async def interrupt_and_resume() -> dict[str, Any]:
+                    """Cancels a cycle once cancel_after accounts have been requested, then resumes it."""
+                    nearblocks.accounts.clear()
+                    task = asyncio.create_task(service_worker.run_cycle())
+                    while not task.done() and len(nearblocks.accounts) < options['cancel_after']:
+                        await asyncio.sleep(0.005)
+                    task.cancel()
+                    with contextlib.suppress(asyncio.CancelledError):
+                        await task
+                    cycle = sqlite_adapter.get_open_cycle()
+                    outstanding = {row['name'] for row in sqlite_adapter.outstanding_accounts(cycle['id'], 0)} if cycle is not None else set()
+                    nearblocks.accounts.clear()
+                    await service_worker.run_cycle()
+                    refetched = set(nearblocks.accounts)
+                    return {'outstanding': len(outstanding), 'refetched': len(refetched),
+                            'ok': bool(outstanding) and refetched == outstanding and sqlite_adapter.count() == options['accounts']}
+
+                async def fail_and_recover() -> dict[str, Any]:
+                    """Fails one sheet write while accounts are added, then removes accounts and checks the sheet against SQLite."""
+                    if sqlite_adapter.count() == 0:
+                        await service_worker.run_cycle()
+                    read_sheet.values += [['bench-new1.tg', '24'], ['bench-new2.tg', '24']]
+                    write_sheet.fail_next['values.batchUpdate'] = 1
+                    await service_worker.run_cycle()
+                    del read_sheet.values[1:3]
+                    await service_worker.run_cycle()
+                    expected = [row[0] for chunk in sqlite_adapter.read_export(('name',)) for row in chunk]
+                    actual = [row[0] for row in write_sheet.values[1:]]
+                    return {'expected': len(expected), 'actual': len(actual), 'ok': actual == expected}
+
+                cycles = []
+                resume = None
+                recovery = None
+                async with target_parser:
+                    if options['cancel_after']:
+                        resume = await interrupt_and_resume()
+                    if options['check_sheet_recovery']:
+                        recovery = await fail_and_recover()
+                    for cycle in range(options['cycles']):
+                        for i in range(options['feed_events'] if cycle else 0):
+                            nearblocks.add_feed_event(f'bench{i}.tg')
+                        nearblocks.requests.clear()
+                        read_sheet.calls.clear()
+                        write_sheet.calls.clear()
+                        started = time.perf_counter()
+                        await service_worker.run_cycle()
+                        wall_time = time.perf_counter() - started
+                        cycles.append({'wall_time': wall_time,
+                                       # Throttled requests are counted by route too, before being answered with 429
+                                       'requests_per_account': (sum(v for k, v in nearblocks.requests.items() if k != '429')
+                                                                - nearblocks.requests['429']) / options['accounts'],
+                                       'throttled': nearblocks.requests['429'],
+                                       'sheets_calls': read_sheet.total_calls + write_sheet.total_calls,
+                                       'rows': len(write_sheet.values) - 1})
+        return {'accounts': options['accounts'], 'cycles': cycles, 'resume': resume, 'recovery': recovery,
+                'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+    return asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--accounts', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--cycles', type=int, default=2, help='later cycles exercise the caches and incremental sync')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--rps', type=float, default=0, help='client request budget, 0 disables rate limiting')
+    parser.add_argument('--latency', type=float, default=0.02, help='fake API latency per request, seconds')
+    parser.add_argument('--pages', type=int, default=3, help='txns pages per account, first MINT is the oldest txn')
+    parser.add_argument('--scan-order', choices=('asc', 'desc'), default='asc')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=0)
+    parser.add_argument('--sheet-sync-interval', type=float, default=60)
+    parser.add_argument('--ingest-mode', choices=('poll', 'feed'), default='poll')
+    parser.add_argument('--scheduling', choices=('sweep', 'priority'), default='sweep')
+    parser.add_argument('--feed-events', type=int, default=10, help='feed events for distinct accounts added before every later cycle')
+    parser.add_argument('--json-backend', choices=('auto', 'msgspec', 'orjson', 'json'), default='auto')
+    parser.add_argument('--http-cache-ttl', type=float, default=300, help='account/inventory cache TTL, 0 disables the cache')
+    parser.add_argument('--cancel-after', type=int, default=0,
+                        help='cancel the first cycle after this many accounts and check that resuming refetches only the rest')
+    parser.add_argument('--check-sheet-recovery', action='store_true',
+                        help='fail one output sheet write, remove accounts and check that the sheet matches SQLite')
+    parser.add_argument('--trace-path', default='', help='span trace file, .jsonl or SQLite')
+    parser.add_argument('--profiler', choices=('cprofile', 'yappi'), help='run every cycle under a profiler')
+    parser.add_argument('--profile-dir', default='profiles', help='where the pstats files of --profiler go')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    failed = False
+    print(f'{"accounts":>9} {"cycle":>5} {"wall, s":>9} {"req/acc":>8} {"429s":>6} {"sheets":>7} {"rows":>7} {"rss, MB":>8}')
+    for accounts in args.accounts:
+        options = {**vars(args), 'accounts': accounts}
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run_scenario, (options,))
+        for number, cycle in enumerate(result['cycles'], start=1):
+            print(f'{accounts:>9} {number:>5} {cycle["wall_time"]:>9.2f} {cycle["requests_per_account"]:>8.2f} '
+                  f'{cycle["throttled"]:>6} {cycle["sheets_calls"]:>7} {cycle["rows"]:>7} {result["peak_rss_mb"]:>8.1f}')
+        if result['resume'] is not None:
+            resume = result['resume']
+            failed |= not resume['ok']
+            print(f'{accounts:>9} resume: {resume["outstanding"]} accounts outstanding after the cancel, '
+                  f'{resume["refetched"]} refetched: {"OK" if resume["ok"] else "MISMATCH"}')
+        if result['recovery'] is not None:
+            recovery = result['recovery']
+            failed |= not recovery['ok']
+            print(f'{accounts:>9} sheet recovery: {recovery["actual"]} rows in the sheet, '
+                  f'{recovery["expected"]} in SQLite: {"OK" if recovery["ok"] else "MISMATCH"}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Cold-start benchmark: import time of the entry modules, checked against a budget.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_import --budget-ms 500
+
+Every measurement is a fresh interpreter with -X importtime; the best of
+--repeat runs is reported. Exits with status 1 when a module is over budget
+or pulls in the Google libraries, which should load only with a Sheets adapter.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ('target_parser', 'service_worker', 'app')
+LAZY_MODULES = ('gspread', 'google.oauth2', 'googleapiclient')
+
+
+def measure(module: str) -> tuple[float, list[str]]:
+    """Returns the cumulative import time of `module` in ms and the lazy modules it loaded."""
+    check = f'import sys, {module}; print(",".join(m for m in {LAZY_MODULES!r} if m in sys.modules))'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', check],
+                            cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+    cumulative_us = 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].strip() == module:
+            cumulative_us = int(parts[1])
+    loaded = [name for name in result.stdout.strip().split(',') if name]
+    return cumulative_us / 1000, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modules', nargs='+', default=list(MODULES))
+    parser.add_argument('--budget-ms', type=float, default=500)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    failed = False
+    print(f'{"module":>16} {"import, ms":>11} {"budget, ms":>11}  eager Google imports')
+    for module in args.modules:
+        runs = [measure(module) for _ in range(args.repeat)]
+        best = min(duration for duration, _ in runs)
+        loaded = runs[0][1]
+        over = best > args.budget_ms or bool(loaded)
+        failed |= over
+        print(f'{module:>16} {best:>11.1f} {args.budget_ms:>11.0f}  {", ".join(loaded) or "-"}{"  FAIL" if over else ""}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
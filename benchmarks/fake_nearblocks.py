@@ -0,0 +1,137 @@
+"""Local stand-in for the nearblocks endpoints used by TargetParser."""
+import asyncio
+import hashlib
+import json
+import random
+from collections import Counter
+from aiohttp import web
+
+CONTRACT_NAME = 'game.hot.tg'
+PER_PAGE = 25
+# 2024-01-01T00:00:00Z in nanoseconds
+BASE_TIMESTAMP = 1_704_067_200 * 10**9
+
+
+def txn_hash(account: str) -> str:
+    return hashlib.sha256(account.encode()).hexdigest()[:44]
+
+
+class FakeNearblocks:
+    """Serves /v1/fts/game.hot.tg/txns, /v1/txns/{hash} and /v1/account/{id}[/inventory].
+
+    Account and inventory responses carry an ETag and honour If-None-Match.
+
+    Every account has `pages` pages of txns with its first MINT as the oldest
+    one; without `a` the txns endpoint serves the contract-wide `feed`. `order` and `per_page` query parameters are honoured like upstream. `error_rate` of the requests are answered with
+    429 and a Retry-After of `retry_after` seconds.
+    """
+    def __init__(self, latency: float = 0.02, pages: int = 3, error_rate: float = 0.0, retry_after: float = 0):
+        self.latency = latency
+        self.pages = pages
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.requests: Counter = Counter()
+        # Requests per account, for txns pages and account lookups
+        self.accounts: Counter = Counter()
+        self.__mint_accounts: dict[str, str] = {}
+        # Contract-wide txns feed, oldest first
+        self.feed: list[dict] = []
+        self.__runner = None
+        self.base_url = ''
+
+    @property
+    def base_urls(self) -> dict[str, str]:
+        return {'txns': f'{self.base_url}/v1/fts/{CONTRACT_NAME}/txns',
+                'txn': f'{self.base_url}/v1/txns',
+                'account': f'{self.base_url}/v1/account'}
+
+    async def __aenter__(self) -> 'FakeNearblocks':
+        app = web.Application(middlewares=[self.__middleware])
+        app.router.add_get(f'/v1/fts/{CONTRACT_NAME}/txns', self.txns)
+        app.router.add_get(f'/v1/fts/{CONTRACT_NAME}/txns/count', self.txns_count)
+        app.router.add_get('/v1/txns/{hash}', self.txn)
+        app.router.add_get('/v1/account/{account}', self.account)
+        app.router.add_get('/v1/account/{account}/inventory', self.inventory)
+        self.__runner = web.AppRunner(app, access_log=None)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, '127.0.0.1', 0)
+        await site.start()
+        port = self.__runner.addresses[0][1]
+        self.base_url = f'http://127.0.0.1:{port}'
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.__runner.cleanup()
+
+    @web.middleware
+    async def __middleware(self, request: web.Request, handler):
+        resource = request.match_info.route.resource
+        self.requests[resource.canonical if resource is not None else 'unknown'] += 1
+        account = request.query.get('a') or request.match_info.get('account')
+        if account:
+            self.accounts[account] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            self.requests['429'] += 1
+            return web.json_response({'message': 'Too many requests'}, status=429,
+                                     headers={'Retry-After': str(self.retry_after)})
+        return await handler(request)
+
+    def _account_txns(self, account: str) -> list[dict]:
+        """All txns of an account, oldest first; the oldest one is its first MINT."""
+        self.__mint_accounts[txn_hash(account)] = account
+        txns = [{'event_index': str(i),
+                 'affected_account_id': account,
+                 'involved_account_id': 'somebody.near',
+                 'transaction_hash': txn_hash(f'{account}-{i}'),
+                 'cause': 'TRANSFER',
+                 'delta_amount': '1000000',
+                 'block_timestamp': str(BASE_TIMESTAMP + i * 10**12)}
+                for i in range(self.pages * PER_PAGE)]
+        txns[0].update({'involved_account_id': None, 'transaction_hash': txn_hash(account), 'cause': 'MINT'})
+        return txns
+
+    def add_feed_event(self, account: str):
+        """Appends a transfer to `account` to the contract-wide feed."""
+        event_index = len(self.feed) + 1
+        self.feed.append({'event_index': str(event_index),
+                          'affected_account_id': account,
+                          'involved_account_id': 'somebody.near',
+                          'transaction_hash': txn_hash(f'feed-{event_index}'),
+                          'cause': 'TRANSFER',
+                          'delta_amount': '1000000',
+                          'block_timestamp': str(BASE_TIMESTAMP + event_index * 10**9)})
+
+    async def txns(self, request: web.Request) -> web.Response:
+        page = int(request.query.get('page', 1))
+        per_page = int(request.query.get('per_page', PER_PAGE))
+        txns = self._account_txns(request.query['a']) if 'a' in request.query else list(self.feed)
+        if request.query.get('order', 'desc') == 'desc':
+            txns.reverse()
+        return web.json_response({'txns': txns[(page - 1) * per_page:page * per_page]})
+
+    async def txns_count(self, request: web.Request) -> web.Response:
+        return web.json_response({'txns': [{'count': str(self.pages * PER_PAGE)}]})
+
+    async def txn(self, request: web.Request) -> web.Response:
+        account = self.__mint_accounts.get(request.match_info['hash'], '')
+        return web.json_response({'txns': [{'transaction_hash': request.match_info['hash'],
+                                            'receipts': [{'fts': [{'affected_account_id': account}]}]}]})
+
+    @staticmethod
+    def _conditional_response(request: web.Request, data: dict) -> web.Response:
+        """JSON response with an ETag; a matching If-None-Match gets an empty 304."""
+        body = json.dumps(data).encode()
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(body=body, content_type='application/json', headers={'ETag': etag})
+
+    async def account(self, request: web.Request) -> web.Response:
+        return self._conditional_response(request, {'account': [{'account_id': request.match_info['account'],
+                                                                 'amount': '12500000000000000000000000'}]})
+
+    async def inventory(self, request: web.Request) -> web.Response:
+        return self._conditional_response(request, {'inventory': {'fts': [{'contract': 'usdt.tether-token.near', 'amount': '1'},
+                                                                          {'contract': CONTRACT_NAME, 'amount': '42000000'}]}})
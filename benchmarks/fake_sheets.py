@@ -0,0 +1,104 @@
+"""In-memory stand-in for the gspread worksheets used by ServiceReader and ServiceUpdater."""
+import re
+from collections import Counter
+from typing import Any, Optional
+
+
+class FakeQuotaError(Exception):
+    """Raised by calls made to fail through FakeWorksheet.fail_next."""
+
+_A1_CELL = re.compile(r'([A-Z]+)(\d+)')
+
+
+def _cell_to_index(cell: str) -> tuple[int, int]:
+    column, row = _A1_CELL.fullmatch(cell).groups()
+    col = 0
+    for char in column:
+        col = col * 26 + ord(char) - 64
+    return int(row) - 1, col - 1
+
+
+class FakeSpreadsheet:
+    def __init__(self, worksheet: 'FakeWorksheet'):
+        self.__worksheet = worksheet
+
+    def batch_update(self, body: dict[str, Any]) -> dict:
+        self.__worksheet.calls['spreadsheets.batchUpdate'] += 1
+        for request in body.get('requests', []):
+            if 'deleteDimension' in request:
+                range_ = request['deleteDimension']['range']
+                del self.__worksheet.values[range_['startIndex']:range_['endIndex']]
+        return {}
+
+    def fetch_sheet_metadata(self, params: Optional[dict] = None) -> dict:
+        self.__worksheet.calls['spreadsheets.get'] += 1
+        return {'sheets': [{'properties': {'sheetId': self.__worksheet.id}, 'conditionalFormats': []}]}
+
+
+class FakeWorksheet:
+    """Keeps cell values in a list of rows and counts every call that would hit the Sheets API."""
+    def __init__(self, values: Optional[list[list[Any]]] = None, row_count: int = 1000):
+        self.id = 0
+        self.values: list[list[Any]] = values or []
+        self.row_count = row_count
+        self.calls: Counter = Counter()
+        # Number of upcoming calls, by API method, to reject as over quota
+        self.fail_next: Counter = Counter()
+        self.spreadsheet = FakeSpreadsheet(self)
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def __set(self, cell: str, rows: list[list[Any]]):
+        row, col = _cell_to_index(cell.split(':')[0])
+        for i, values in enumerate(rows):
+            while len(self.values) <= row + i:
+                self.values.append([])
+            target = self.values[row + i]
+            if len(target) < col + len(values):
+                target.extend([''] * (col + len(values) - len(target)))
+            target[col:col + len(values)] = values
+
+    def get_all_values(self) -> list[list[Any]]:
+        self.calls['values.get'] += 1
+        return [list(row) for row in self.values]
+
+    def row_values(self, row: int) -> list[Any]:
+        self.calls['values.get'] += 1
+        return list(self.values[row - 1]) if row <= len(self.values) else []
+
+    def update(self, values: list[list[Any]], range_name: str = 'A1', **kwargs):
+        self.calls['values.update'] += 1
+        self.__set(range_name, values)
+
+    def batch_update(self, data: list[dict[str, Any]], **kwargs):
+        self.calls['values.batchUpdate'] += 1
+        if self.fail_next['values.batchUpdate'] > 0:
+            self.fail_next['values.batchUpdate'] -= 1
+            raise FakeQuotaError('Quota exceeded for values.batchUpdate')
+        for item in data:
+            self.__set(item['range'], item['values'])
+
+    def format(self, ranges: str, format: dict[str, Any]):
+        self.calls['spreadsheets.batchUpdate'] += 1
+
+    def clear(self):
+        self.calls['values.clear'] += 1
+        self.values = []
+
+    def add_rows(self, rows: int):
+        self.calls['spreadsheets.batchUpdate'] += 1
+        self.row_count += rows
+
+
+class FakeServiceAuth:
+    """Drop-in for ServiceAuth that hands out worksheets registered by (sheet title, worksheet name)."""
+    worksheets: dict[tuple[str, str], FakeWorksheet] = {}
+
+    def __init__(self, service_account_file, scopes, sheet_title, worksheet_name, sheet_key=None):
+        self.sheet_title = sheet_title
+        self.worksheet_name = worksheet_name
+
+    def get_google_sheet(self) -> FakeWorksheet:
+        return self.worksheets.setdefault((self.sheet_title, self.worksheet_name), FakeWorksheet())
@@ -0,0 +1,115 @@
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+from settings import logger
+
+
+class CacheEntry:
+    __slots__ = ('data', 'body', 'etag', 'last_modified', 'expires_at')
+
+    def __init__(self, data: Any, body: Optional[bytes], etag: Optional[str], last_modified: Optional[str], expires_at: float):
+        self.data = data
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expires_at = expires_at
+
+    @property
+    def fresh(self) -> bool:
+        return time.time() < self.expires_at
+
+    @property
+    def revalidatable(self) -> bool:
+        return self.etag is not None or self.last_modified is not None
+
+
+class HttpCache:
+    """Response cache for GET requests, keyed by URL with its query parameters.
+
+    Entries live for a per-endpoint TTL; stale entries that carry an ETag or
+    Last-Modified are revalidated with a conditional request instead of being
+    refetched. Parsed payloads are kept in a bounded LRU, so a hit or a 304
+    costs no JSON parsing. With `sqlite_path` raw bodies are also persisted
+    and survive restarts; without it they are not kept at all.
+    """
+    def __init__(self, ttls: dict[str, float], max_entries: int = 50000, sqlite_path: Optional[str] = None,
+                 commit_every: int = 100):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.__entries: OrderedDict[str, CacheEntry] = OrderedDict()
+        self.__commit_every = commit_every
+        self.__uncommitted = 0
+        self.__conn: Optional[sqlite3.Connection] = None
+        if sqlite_path:
+            self.__conn = sqlite3.connect(sqlite_path)
+            self.__conn.execute('PRAGMA journal_mode=WAL')
+            self.__conn.execute('PRAGMA synchronous=OFF')
+            self.__conn.execute("""CREATE TABLE IF NOT EXISTS http_cache (
+                url TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                expires_at REAL NOT NULL
+            )""")
+            self.__conn.commit()
+
+    def enabled_for(self, endpoint: str) -> bool:
+        return self.ttls.get(endpoint, 0) > 0
+
+    def get(self, key: str, loads) -> Optional[CacheEntry]:
+        """Returns the entry for `key`; `loads` parses bodies restored from the backing store."""
+        entry = self.__entries.get(key)
+        if entry is not None:
+            self.__entries.move_to_end(key)
+            return entry
+        if self.__conn is None:
+            return None
+        record = self.__conn.execute("SELECT body, etag, last_modified, expires_at FROM http_cache WHERE url = ?", (key,)).fetchone()
+        if record is None:
+            return None
+        body, etag, last_modified, expires_at = record
+        entry = CacheEntry(loads(body), body, etag, last_modified, expires_at)
+        self.__remember(key, entry)
+        return entry
+
+    def put(self, key: str, endpoint: str, data: Any, body: bytes, etag: Optional[str], last_modified: Optional[str]) -> CacheEntry:
+        entry = CacheEntry(data, body if self.__conn is not None else None, etag, last_modified, time.time() + self.ttls[endpoint])
+        self.__remember(key, entry)
+        self.__store(key, entry)
+        return entry
+
+    def touch(self, key: str, endpoint: str, entry: CacheEntry):
+        """Extends the life of an entry the server confirmed as unchanged."""
+        entry.expires_at = time.time() + self.ttls[endpoint]
+        self.__remember(key, entry)
+        self.__store(key, entry)
+
+    def __remember(self, key: str, entry: CacheEntry):
+        self.__entries[key] = entry
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+
+    def __store(self, key: str, entry: CacheEntry):
+        if self.__conn is None:
+            return
+        try:
+            self.__conn.execute("INSERT OR REPLACE INTO http_cache (url, body, etag, last_modified, expires_at) VALUES (?, ?, ?, ?, ?)",
+                                (key, entry.body, entry.etag, entry.last_modified, entry.expires_at))
+            self.__uncommitted += 1
+            if self.__uncommitted >= self.__commit_every:
+                self.flush()
+        except sqlite3.Error as e:
+            logger.error(f'[HttpCache] An error occurred while storing {key}: {e}')
+
+    def flush(self):
+        if self.__conn is not None and self.__uncommitted:
+            self.__conn.commit()
+            self.__uncommitted = 0
+
+    def close(self):
+        if self.__conn is not None:
+            self.flush()
+            self.__conn.close()
+            self.__conn = None
@@ -0,0 +1,119 @@
+"""JSON decoding of nearblocks responses with a pluggable backend.
+
+`msgspec` decodes each kind of response into TypedDicts that declare only the
+fields the parser reads, skipping the rest of the payload; `orjson` and the
+stdlib `json` decode the whole document. Either way the decoder is fed the raw
+response bytes and returns plain dicts.
+"""
+import json
+from typing import Any, Callable, Optional, TypedDict
+from settings import logger
+
+# Scalars that nearblocks sends as strings but may send as numbers
+Scalar = Any
+
+
+class FtTxn(TypedDict, total=False):
+    event_index: Scalar
+    affected_account_id: Optional[str]
+    involved_account_id: Optional[str]
+    transaction_hash: Optional[str]
+    cause: Optional[str]
+    delta_amount: Scalar
+    block_timestamp: Scalar
+
+
+class TxnsPage(TypedDict, total=False):
+    txns: list[FtTxn]
+
+
+class TxnsCount(TypedDict, total=False):
+    count: Scalar
+
+
+class TxnsCountPage(TypedDict, total=False):
+    txns: list[TxnsCount]
+
+
+class ReceiptFt(TypedDict, total=False):
+    affected_account_id: Optional[str]
+
+
+class Receipt(TypedDict, total=False):
+    fts: list[ReceiptFt]
+
+
+class Txn(TypedDict, total=False):
+    receipts: list[Receipt]
+
+
+class TxnPage(TypedDict, total=False):
+    txns: list[Txn]
+
+
+class Account(TypedDict, total=False):
+    amount: Scalar
+
+
+class AccountPage(TypedDict, total=False):
+    account: list[Account]
+
+
+class InventoryFt(TypedDict, total=False):
+    contract: Optional[str]
+    amount: Scalar
+
+
+class Inventory(TypedDict, total=False):
+    fts: list[InventoryFt]
+
+
+class InventoryPage(TypedDict, total=False):
+    inventory: Inventory
+
+
+# Response kinds passed to TargetParser._fetch_data
+SCHEMAS: dict[str, type] = {
+    'txns': TxnsPage,
+    'txns_count': TxnsCountPage,
+    'txn': TxnPage,
+    'account': AccountPage,
+    'inventory': InventoryPage,
+}
+
+BACKENDS = ('msgspec', 'orjson', 'json')
+
+
+class JsonDecoder:
+    """Decodes response bodies with the first available of `backend` ('auto' tries msgspec, orjson, json in turn)."""
+    def __init__(self, backend: str = 'auto'):
+        candidates = BACKENDS if backend == 'auto' else (backend,)
+        for name in candidates:
+            try:
+                self.__decoders = self.__build(name)
+                self.backend = name
+                break
+            except ImportError:
+                continue
+        else:
+            raise ImportError(f'JSON backend {backend!r} is not installed')
+        logger.info(f'[JsonDecoder] Using {self.backend}')
+
+    @staticmethod
+    def __build(name: str) -> dict[Optional[str], Callable[[bytes], Any]]:
+        if name == 'msgspec':
+            import msgspec
+            decoders = {kind: msgspec.json.Decoder(schema).decode for kind, schema in SCHEMAS.items()}
+            decoders[None] = msgspec.json.Decoder().decode
+            return decoders
+        if name == 'orjson':
+            import orjson
+            return {None: orjson.loads}
+        if name == 'json':
+            return {None: json.loads}
+        raise ValueError(f'Unknown JSON backend: {name}')
+
+    def decode(self, body: bytes, kind: Optional[str] = None) -> Any:
+        """Decodes `body`; with a known `kind` and msgspec only the fields of its schema are kept."""
+        decoder = self.__decoders.get(kind) or self.__decoders[None]
+        return decoder(body)
@@ -0,0 +1,136 @@
+"""Minimal Prometheus-style metrics, exposed as text format over a local HTTP endpoint."""
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Sequence
+from settings import logger
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry: list['Metric'] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+class Metric(ABC):
+    kind = ''
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        _registry.append(self)
+
+    @abstractmethod
+    def samples(self) -> list[str]:
+        ...
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}', *self.samples()])
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self.__values: dict[tuple[tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.__values[key] = self.__values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{_format_labels(key)} {value}' for key, value in self.__values.items()]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self.__values: dict[tuple[tuple[str, str], ...], float] = {}
+
+    def set(self, value: float, **labels):
+        self.__values[tuple(sorted(labels.items()))] = value
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{_format_labels(key)} {value}' for key, value in self.__values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: counts per bucket (last one is +Inf), sum
+        self.__values: dict[tuple[tuple[str, str], ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        if key not in self.__values:
+            self.__values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = self.__values[key]
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total) in self.__values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels((*key, ("le", str(bound))))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {total[0]}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {cumulative}')
+        return lines
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+http_requests = Counter('bc_parser_http_requests_total', 'Requests to nearblocks by base_urls key and response status.')
+http_request_duration = Histogram('bc_parser_http_request_duration_seconds', 'Latency of requests to nearblocks by base_urls key.')
+http_cache = Counter('bc_parser_http_cache_total', 'HTTP cache lookups by cached endpoint and result: hit, revalidated or miss.')
+parse_outcomes = Counter('bc_parser_parse_total', 'Parsed accounts by outcome: found, not_found or error.')
+sqlite_batch_duration = Histogram('bc_parser_sqlite_batch_duration_seconds', 'Duration of SQLite batch writes.')
+sheets_calls = Counter('bc_parser_sheets_calls_total', 'Google Sheets API calls by method.')
+sheets_quota_errors = Counter('bc_parser_sheets_quota_errors_total', 'Google Sheets API calls rejected for exceeding the quota.')
+cycle_duration = Histogram('bc_parser_cycle_duration_seconds', 'Duration of a full parsing cycle.',
+                           buckets=(10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200))
+failed_accounts = Gauge('bc_parser_failed_accounts', 'Accounts left failed after the retries of the last cycle.')
+last_cycle_duration = Gauge('bc_parser_last_cycle_duration_seconds', 'Duration of the last parsing cycle.')
+
+
+async def start_metrics_server(host: str, port: int):
+    """Serves /metrics on host:port; returns the aiohttp runner to clean up on shutdown."""
+    from aiohttp import web
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f'[Metrics] Serving on http://{host}:{port}/metrics')
+    return runner
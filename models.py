@@ -1,11 +1,12 @@
-from pydantic import BaseModel, field_serializer
-from typing import Optional, Any
+from typing import NamedTuple, Optional
 
-class Transaction(BaseModel):
-    hash: Optional[str] = None
+
+class TransactionRecord(NamedTuple):
+    """Serialized account row; fields are in the order of the upsert parameters and the output sheet columns."""
     name: str
+    hash: Optional[str] = None
     quantity: Optional[float] = None
-    age: Optional[int] = None
     near_amount: Optional[float] = None
     hot_amount: Optional[float] = None
-    claim_period: Optional[int] = None
\ No newline at end of file
+    age: Optional[int] = None
+    claim_period: Optional[int] = None
@@ -6,5 +6,46 @@ CREATE TABLE IF NOT EXISTS transactions (
             near_amount INTEGER,
             hot_amount INTEGER,
             age INT,
-            claim_period INTEGER
-        )
\ No newline at end of file
+            claim_period INTEGER,
+            version INTEGER NOT NULL DEFAULT 1,
+            synced_version INTEGER NOT NULL DEFAULT 0,
+            sheet_row INTEGER,
+            data_version INTEGER NOT NULL DEFAULT 1
+        );
+CREATE TABLE IF NOT EXISTS first_mints (
+            name TEXT PRIMARY KEY,
+            hash CHAR(64) NOT NULL,
+            delta_amount TEXT,
+            block_timestamp TEXT NOT NULL
+        );
+CREATE TABLE IF NOT EXISTS feed_state (
+            feed TEXT PRIMARY KEY,
+            event_index TEXT NOT NULL,
+            refreshed_at REAL NOT NULL
+        );
+CREATE TABLE IF NOT EXISTS cycles (
+            id INTEGER PRIMARY KEY,
+            started_at REAL NOT NULL,
+            finished_at REAL,
+            feed_event_index TEXT,
+            feed_refreshed_at REAL
+        );
+CREATE TABLE IF NOT EXISTS cycle_accounts (
+            cycle_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            claim_period TEXT,
+            status TEXT NOT NULL,
+            retries INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            PRIMARY KEY (cycle_id, name)
+        );
+CREATE TABLE IF NOT EXISTS schedule (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            failures INTEGER NOT NULL DEFAULT 0,
+            next_refresh_at REAL NOT NULL
+        );
+CREATE TABLE IF NOT EXISTS freed_rows (
+            id INTEGER PRIMARY KEY,
+            sheet_row INTEGER NOT NULL
+        );
@@ -0,0 +1,6 @@
+UPDATE transactions
+SET age = CAST((:now - CAST(first_mints.block_timestamp AS REAL) / 1e9) / 3600 AS INTEGER),
+    version = version + 1
+FROM first_mints
+WHERE first_mints.name = transactions.name
+  AND transactions.age IS NOT CAST((:now - CAST(first_mints.block_timestamp AS REAL) / 1e9) / 3600 AS INTEGER);
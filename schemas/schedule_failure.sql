@@ -0,0 +1,7 @@
+INSERT INTO schedule (name, version, failures, next_refresh_at)
+SELECT name, 0, 1, :now + :min_interval
+FROM cycle_accounts
+WHERE cycle_id = :cycle_id AND status IN ('pending', 'failed')
+ON CONFLICT(name) DO UPDATE SET
+    failures = failures + 1,
+    next_refresh_at = :now + min(:max_interval, :min_interval * (1 << min(failures, 16)));
@@ -0,0 +1,13 @@
+INSERT INTO schedule (name, version, failures, next_refresh_at)
+SELECT t.name, t.data_version, 0,
+       :now + max(:min_interval, min(:max_interval,
+           CASE WHEN t.age IS NULL OR t.claim_period IS NULL THEN :max_interval
+                ELSE abs(t.claim_period - t.age) * 3600 * :factor
+           END
+           * CASE WHEN t.data_version != COALESCE(s.version, 0) THEN 0.5 ELSE 1 END))
+FROM transactions t LEFT JOIN schedule s ON s.name = t.name
+WHERE t.name = :name
+ON CONFLICT(name) DO UPDATE SET
+    version = excluded.version,
+    failures = 0,
+    next_refresh_at = excluded.next_refresh_at;
@@ -0,0 +1,20 @@
+INSERT INTO transactions (name, hash, quantity, near_amount, hot_amount, age, claim_period)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(name) DO UPDATE SET
+            hash = excluded.hash,
+            quantity = excluded.quantity,
+            near_amount = excluded.near_amount,
+            hot_amount = excluded.hot_amount,
+            age = excluded.age,
+            claim_period = excluded.claim_period,
+            version = version + 1,
+            data_version = data_version + (hash IS NOT excluded.hash
+                                           OR quantity IS NOT excluded.quantity
+                                           OR near_amount IS NOT excluded.near_amount
+                                           OR hot_amount IS NOT excluded.hot_amount)
+WHERE hash IS NOT excluded.hash
+   OR quantity IS NOT excluded.quantity
+   OR near_amount IS NOT excluded.near_amount
+   OR hot_amount IS NOT excluded.hot_amount
+   OR age IS NOT excluded.age
+   OR claim_period IS NOT excluded.claim_period;
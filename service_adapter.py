@@ -1,29 +1,62 @@
 # service_adapter.py
-from typing import Any, Tuple
-from service_auth import ServiceAuth
-from gspread.utils import ValueInputOption
-from gspread_formatting import (CellFormat, Color, TextFormat,
-                                Borders, Border, format_cell_range,
-                                set_column_widths, get_conditional_format_rules,
-                                ConditionalFormatRule, GridRange, BooleanRule,
-                                BooleanCondition)
+from typing import Any, Callable, Iterable, Mapping, Optional, Tuple, Union
 from settings import logger
+import metrics
+import operator
+import sqlite3
 from datetime import datetime
 
+# gspread's ValueInputOption.user_entered; gspread itself is imported only once an adapter is built
+USER_ENTERED = 'USER_ENTERED'
+
 
 class ServiceAdapter:
-    def __init__(self, service_account_file: str, scopes: list[str], sheet_name: str, worksheet_name: str, headers: Tuple[str, ...]):
-        self.__service_auth = ServiceAuth(service_account_file, scopes, sheet_name, worksheet_name)
-        self._worksheet = self.__service_auth.get_google_sheet()
+    """Base for worksheet adapters.
+
+    The worksheet is opened on first use through the shared ServiceAuth
+    client, and headers are written only if the sheet does not already have them.
+    """
+    def __init__(self, service_account_file: str, scopes: list[str], sheet_name: str, worksheet_name: str, headers: Tuple[str, ...],
+                 sheet_key: Optional[str] = None):
+        from service_auth import ServiceAuth
+        self.__service_auth = ServiceAuth(service_account_file, scopes, sheet_name, worksheet_name, sheet_key=sheet_key)
+        self.__worksheet = None
         self.num_header_rows = 1
         self.headers = headers
-        self._set_headers()
+
+    @property
+    def _worksheet(self):
+        if self.__worksheet is None:
+            self.__worksheet = self.__service_auth.get_google_sheet()
+            self._ensure_headers()
+        return self.__worksheet
+
+    def _call_api(self, method: str, func: Callable, *args, **kwargs) -> Any:
+        """Calls the Sheets API through gspread, counting the call and quota rejections."""
+        metrics.sheets_calls.inc(method=method)
+        from gspread.exceptions import APIError
+        try:
+            return func(*args, **kwargs)
+        except APIError as e:
+            if e.response.status_code == 429:
+                metrics.sheets_quota_errors.inc(method=method)
+            raise
+
+    def _ensure_headers(self):
+        try:
+            current = self._call_api('values.get', self._worksheet.row_values, 1)
+            if tuple(current[:len(self.headers)]) != tuple(self.headers):
+                self._set_headers()
+            else:
+                logger.debug(f'[ServiceAdapter] Headers already set: {self.headers}')
+        except Exception as e:
+            logger.error(f'[ServiceAdapter] An error occurred while checking headers: {e}')
 
     def _set_headers(self):
         try:
-            self._worksheet.update([self.headers], value_input_option=ValueInputOption.user_entered)
+            self._call_api('values.update', self._worksheet.update, [self.headers], value_input_option=USER_ENTERED)
             header_range = f'A1:{chr(65 + len(self.headers) - 1)}1'  # A1:B1 for two headers, A1:C1 for three, etc.
-            self._worksheet.format(header_range, {
+            self._call_api('spreadsheets.batchUpdate', self._worksheet.format, header_range, {
                 "textFormat": {"bold": True}
             })
             
@@ -33,125 +66,173 @@ class ServiceAdapter:
 
 
 class ServiceUpdater(ServiceAdapter):
-    def __init__(self, service_account_file: str, scopes: list[str], sheet_name: str, worksheet_name: str, headers: Tuple[str, ...]):
-        super().__init__(service_account_file, scopes, sheet_name, worksheet_name, headers)
+    """Buffered writer for the output worksheet.
+
+    Row writes are staged and sent by `flush` as a single values.batchUpdate,
+    followed by at most one spreadsheets.batchUpdate carrying all formatting.
+    """
+    solid_borders = {side: {'style': 'SOLID'} for side in ('top', 'bottom', 'left', 'right')}
+
+    def __init__(self, service_account_file: str, scopes: list[str], sheet_name: str, worksheet_name: str, headers: Tuple[str, ...],
+                 sheet_key: Optional[str] = None):
+        super().__init__(service_account_file, scopes, sheet_name, worksheet_name, headers, sheet_key=sheet_key)
+        self.__pending: list[dict[str, Any]] = []
+        self.__row_values = operator.itemgetter(*headers)
+        self.__next_row = self.num_header_rows + 1
+        self.__formatted_rows: Optional[int] = None
+        self.__conditional_rules_count: Optional[int] = None
+
+    @property
+    def last_column(self) -> str:
+        return chr(64 + len(self.headers))
 
     def clear(self):
         logger.info('[ServiceUpdater] Write worksheet truncating...')
         try:
-            self._worksheet.clear()
-            self._set_headers()  # Reset headers after clearing
-            self._apply_formatting()
+            self._call_api('values.clear', self._worksheet.clear)
+            self.__pending.clear()
+            # Headers go out with the next flush, which also reformats them
+            self.__pending.append({'range': f'A1:{self.last_column}1', 'values': [list(self.headers)]})
+            self.__next_row = self.num_header_rows + 1
+            self.__formatted_rows = None
         except Exception as e:
             logger.error(f'[ServiceUpdater] An error occurred while truncating: {e}')
 
-    def append_rows(self, data: list[dict[str, Any]]):
+    def append_rows(self, data: Iterable[Union[Mapping[str, Any], sqlite3.Row, tuple]]):
+        """Stages rows right after the previously staged ones."""
+        for d in data:
+            self.__stage_row(self.__next_row, d)
+
+    def update_rows(self, data: Iterable[Union[Mapping[str, Any], sqlite3.Row]]):
+        """Stages rows to be written in place, at the sheet position stored in each row's 'sheet_row'."""
+        for d in data:
+            self.__stage_row(d['sheet_row'], d)
+
+    def __stage_row(self, sheet_row: int, d: Union[Mapping[str, Any], sqlite3.Row, tuple]):
+        """Rows are read by header name; tuples such as TransactionRecord must already be in header order."""
+        values = list(d) if isinstance(d, tuple) else list(self.__row_values(d))
+        self.__pending.append({'range': f'A{sheet_row}:{self.last_column}{sheet_row}', 'values': [values]})
+        self.__next_row = max(self.__next_row, sheet_row + 1)
+
+    def delete_rows(self, sheet_rows: list[int]):
+        """Deletes sheet rows in one request, one after another; each row number is taken after the previous deletions."""
         try:
-            rows_to_append = [[d.get(header, '') for header in self.headers] for d in data]
-            self._worksheet.append_rows(rows_to_append, value_input_option=ValueInputOption.user_entered)
-            logger.debug(f'[ServiceUpdater] Rows appended: {data}')
-            self._apply_formatting()
+            self._call_api('spreadsheets.batchUpdate', self._worksheet.spreadsheet.batch_update, {'requests': [
+                {'deleteDimension': {'range': {'sheetId': self._worksheet.id, 'dimension': 'ROWS',
+                                               'startIndex': sheet_row - 1, 'endIndex': sheet_row}}}
+                for sheet_row in sheet_rows
+            ]})
+            logger.debug(f'[ServiceUpdater] Rows deleted: {sheet_rows}')
         except Exception as e:
-            logger.error(f'[ServiceUpdater] An error occurred while appending rows: {e}')
+            logger.error(f'[ServiceUpdater] An error occurred while deleting rows: {e}')
+            raise
 
     def update_last_updated(self):
+        """Stages the 'last updated' timestamp next to the headers."""
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        last_column = chr(65 + len(self.headers))
+        self.__pending.append({'range': f'{last_column}1', 'values': [[current_time]]})
+        logger.debug(f'[ServiceUpdater] Last updated time staged: {current_time}')
+
+    def flush(self, row_count: int):
+        """Sends all staged values in one request and reformats the sheet for `row_count` data rows."""
         try:
-            current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            last_column = len(self.headers)+1
-            cell = self._worksheet.cell(1, last_column)
-            cell.value = current_time
-            self._worksheet.update_cell(1, last_column, current_time)
-            logger.debug(f'[ServiceUpdater] Last updated time set: {current_time}')
+            last_row = self.num_header_rows + row_count
+            if self.__pending:
+                if last_row > self._worksheet.row_count:
+                    self._call_api('spreadsheets.batchUpdate', self._worksheet.add_rows, last_row - self._worksheet.row_count)
+                self._call_api('values.batchUpdate', self._worksheet.batch_update, self.__pending, value_input_option=USER_ENTERED)
+                logger.debug(f'[ServiceUpdater] {len(self.__pending)} ranges written')
+                self.__pending.clear()
+            if self.__formatted_rows != row_count:
+                self._apply_formatting(row_count)
+                self.__formatted_rows = row_count
         except Exception as e:
-            logger.error(f'[ServiceUpdater] An error occurred while updating last updated time: {e}')
-
-    def _apply_formatting(self):
+            logger.error(f'[ServiceUpdater] An error occurred while flushing rows: {e}')
+            # Staged positions go stale once rows are deleted, and rows left unsynced are staged again
+            # from SQLite; only the headers of a cleared sheet are kept, as nothing else rewrites them
+            header_range = f'A1:{self.last_column}1'
+            self.__pending = [item for item in self.__pending if item['range'] == header_range]
+            raise
+
+    def _grid_range(self, start_row: int, end_row: int) -> dict[str, int]:
+        return {'sheetId': self._worksheet.id,
+                'startRowIndex': start_row - 1, 'endRowIndex': end_row,
+                'startColumnIndex': 0, 'endColumnIndex': len(self.headers)}
+
+    def _count_conditional_rules(self) -> int:
+        metadata = self._call_api('spreadsheets.get', self._worksheet.spreadsheet.fetch_sheet_metadata, {'fields': 'sheets(properties.sheetId,conditionalFormats)'})
+        for sheet in metadata.get('sheets', []):
+            if sheet['properties']['sheetId'] == self._worksheet.id:
+                return len(sheet.get('conditionalFormats', []))
+        return 0
+
+    def _apply_formatting(self, row_count: int):
+        """Formats the header and `row_count` data rows with a single spreadsheets.batchUpdate."""
         try:
-            # Get the number of rows with content
-            values = self._worksheet.get_all_values()
-            last_row_with_content = len(values)
-
-            # Define formats
-            header_format = CellFormat(
-                backgroundColor=Color(0.9, 0.9, 0.9),
-                textFormat=TextFormat(bold=True),
-                horizontalAlignment='CENTER',
-                borders=Borders(
-                    top=Border(style='SOLID'),
-                    bottom=Border(style='SOLID'),
-                    left=Border(style='SOLID'),
-                    right=Border(style='SOLID')
-                )
-            )
-
-            body_format = CellFormat(
-                backgroundColor=Color(1, 1, 1),
-                textFormat=TextFormat(bold=False),
-                borders=Borders(
-                    top=Border(style='SOLID'),
-                    bottom=Border(style='SOLID'),
-                    left=Border(style='SOLID'),
-                    right=Border(style='SOLID')
-                )
-            )
-
-            # Apply formats only to rows with content
-            format_cell_range(self._worksheet, f'A1:{chr(64 + len(self.headers))}1', header_format)
-            if last_row_with_content > 1:
-                format_cell_range(self._worksheet, f'A2:{chr(64 + len(self.headers))}{last_row_with_content}', body_format)
-
-            # Set column widths
-            set_column_widths(self._worksheet, [('A:' + chr(64 + len(self.headers)), 150)])
+            last_row = self.num_header_rows + row_count
             age_column = chr(64 + len(self.headers) - 1)
-            claim_period_column = chr(64 + len(self.headers))
-
-            # Only apply conditional formatting if there's more than one row of data
-            if last_row_with_content > 1:
-                format_range = f'A2:{claim_period_column}{last_row_with_content}'
-
-                green_rule = ConditionalFormatRule(
-                    ranges=[GridRange.from_a1_range(format_range, self._worksheet)],
-                    booleanRule=BooleanRule(
-                        condition=BooleanCondition('CUSTOM_FORMULA', [f'=${age_column}2<=${claim_period_column}2']),
-                        format=CellFormat(backgroundColor=Color(0.7, 0.9, 0.7))
-                    )
-                )
-
-                red_rule = ConditionalFormatRule(
-                    ranges=[GridRange.from_a1_range(format_range, self._worksheet)],
-                    booleanRule=BooleanRule(
-                        condition=BooleanCondition('CUSTOM_FORMULA', [f'=${age_column}2>${claim_period_column}2']),
-                        format=CellFormat(backgroundColor=Color(0.9, 0.7, 0.7))
-                    )
-                )
-
-                # Apply the rules
-                rules = get_conditional_format_rules(self._worksheet)
-                rules.clear()  # Clear existing rules
-                rules.append(green_rule)
-                rules.append(red_rule)
-                rules.save()
-
-                logger.info('[ServiceUpdater] Conditional formatting applied successfully')
-            else:
-                logger.info('[ServiceUpdater] No data rows to apply conditional formatting')
-
+            claim_period_column = self.last_column
+            first_data_row = self.num_header_rows + 1
+
+            requests: list[dict[str, Any]] = [
+                {'repeatCell': {
+                    'range': self._grid_range(1, self.num_header_rows),
+                    'cell': {'userEnteredFormat': {'backgroundColor': {'red': 0.9, 'green': 0.9, 'blue': 0.9},
+                                                   'textFormat': {'bold': True},
+                                                   'horizontalAlignment': 'CENTER',
+                                                   'borders': self.solid_borders}},
+                    'fields': 'userEnteredFormat(backgroundColor,textFormat,horizontalAlignment,borders)'}},
+                {'updateDimensionProperties': {
+                    'range': {'sheetId': self._worksheet.id, 'dimension': 'COLUMNS',
+                              'startIndex': 0, 'endIndex': len(self.headers)},
+                    'properties': {'pixelSize': 150},
+                    'fields': 'pixelSize'}},
+            ]
+
+            # Conditional rules are owned by this writer: it only has to read them once
+            if self.__conditional_rules_count is None:
+                self.__conditional_rules_count = self._count_conditional_rules()
+            requests += [{'deleteConditionalFormatRule': {'sheetId': self._worksheet.id, 'index': 0}}
+                         for _ in range(self.__conditional_rules_count)]
+            self.__conditional_rules_count = 0
+
+            if row_count > 0:
+                body_range = self._grid_range(first_data_row, last_row)
+                requests.append({'repeatCell': {
+                    'range': body_range,
+                    'cell': {'userEnteredFormat': {'backgroundColor': {'red': 1, 'green': 1, 'blue': 1},
+                                                   'textFormat': {'bold': False},
+                                                   'borders': self.solid_borders}},
+                    'fields': 'userEnteredFormat(backgroundColor,textFormat,borders)'}})
+                for formula, color in ((f'=${age_column}{first_data_row}<=${claim_period_column}{first_data_row}', {'red': 0.7, 'green': 0.9, 'blue': 0.7}),
+                                       (f'=${age_column}{first_data_row}>${claim_period_column}{first_data_row}', {'red': 0.9, 'green': 0.7, 'blue': 0.7})):
+                    requests.append({'addConditionalFormatRule': {'index': self.__conditional_rules_count, 'rule': {
+                        'ranges': [body_range],
+                        'booleanRule': {'condition': {'type': 'CUSTOM_FORMULA', 'values': [{'userEnteredValue': formula}]},
+                                        'format': {'backgroundColor': color}}}}})
+                    self.__conditional_rules_count += 1
+
+            self._call_api('spreadsheets.batchUpdate', self._worksheet.spreadsheet.batch_update, {'requests': requests})
+            logger.info(f'[ServiceUpdater] Formatting applied to {row_count} rows')
         except Exception as e:
-            logger.error(f'[ServiceUpdater] An error occurred while applying conditional formatting: {e}')
+            self.__conditional_rules_count = None
+            logger.error(f'[ServiceUpdater] An error occurred while applying formatting: {e}')
 
 
 class ServiceReader(ServiceAdapter):
-    def __init__(self, service_account_file: str, scopes: list[str], sheet_name: str, worksheet_name: str, headers: Tuple[str, ...]):
-        super().__init__(service_account_file, scopes, sheet_name, worksheet_name, headers)
+    def __init__(self, service_account_file: str, scopes: list[str], sheet_name: str, worksheet_name: str, headers: Tuple[str, ...],
+                 sheet_key: Optional[str] = None):
+        super().__init__(service_account_file, scopes, sheet_name, worksheet_name, headers, sheet_key=sheet_key)
 
     def read_columns_generator(self):
         try:
-            all_values = self._worksheet.get_all_values()
+            all_values = self._call_api('values.get', self._worksheet.get_all_values)
             for row in all_values[1:]:  # Skip the header row
                 if row and row[0].strip():  # Check if the row is not empty and the first cell is not just whitespace
-                    logger.debug(f'[ServiceReader] Accepted value: {row}')
+                    logger.debug('[ServiceReader] Accepted value: %s', row)
                     yield row
                 else:
-                    logger.debug(f'[ServiceReader] Skipping empty row: {row}')
+                    logger.debug('[ServiceReader] Skipping empty row: %s', row)
         except Exception as e:
             logger.error(f'[ServiceReader] An error occurred while reading data: {e}')
\ No newline at end of file
@@ -1,14 +1,33 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
 from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from settings import settings, logger
+from google.auth.transport.requests import Request
+from settings import logger
 from gspread.auth import authorize
 import gspread
 
+# Refresh the access token this long before it expires
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+
 class ServiceAuth:
-    def __init__(self, service_account_file, scopes, sheet_title, worksheet_name):
+    """Opens worksheets through one authorized gspread client per service account.
+
+    Clients and spreadsheet handles are shared by every ServiceAuth in the
+    process and created on first use. The access token of each client is kept
+    fresh by a background thread, so no Sheets call has to wait for a refresh.
+    """
+    _clients: dict[tuple[str, tuple[str, ...]], gspread.Client] = {}
+    _spreadsheets: dict[tuple[str, str], gspread.Spreadsheet] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, service_account_file, scopes, sheet_title, worksheet_name, sheet_key: Optional[str] = None):
         self.account_file = service_account_file
         self.scopes = scopes
         self.sheet_title = sheet_title
+        self.sheet_key = sheet_key
         self.worksheet_name = worksheet_name
 
     def __authenticate_service_account(self):
@@ -22,19 +41,54 @@ class ServiceAuth:
             logger.error(f'[Authentication]: Failed: {e}')
             raise
 
+    @staticmethod
+    def __keep_token_fresh(creds: Credentials):
+        request = Request()
+        while True:
+            try:
+                if creds.expiry is None or creds.expiry - datetime.utcnow() < TOKEN_REFRESH_MARGIN:
+                    creds.refresh(request)
+                    logger.debug(f'[Authentication]: Token refreshed, expires at {creds.expiry}')
+                delay = (creds.expiry - datetime.utcnow() - TOKEN_REFRESH_MARGIN).total_seconds()
+            except Exception as e:
+                logger.error(f'[Authentication]: Token refresh failed: {e}')
+                delay = 0
+            time.sleep(max(delay, 60))
+
+    def get_client(self) -> gspread.Client:
+        client_key = (self.account_file, tuple(self.scopes))
+        with self._lock:
+            if client_key not in self._clients:
+                credentials = self.__authenticate_service_account()
+                self._clients[client_key] = authorize(credentials=credentials)
+                threading.Thread(target=self.__keep_token_fresh, args=(credentials,),
+                                 name='sheets-token-refresh', daemon=True).start()
+            return self._clients[client_key]
+
+    def get_spreadsheet(self) -> gspread.Spreadsheet:
+        spreadsheet_key = (self.account_file, self.sheet_key or self.sheet_title)
+        with self._lock:
+            spreadsheet = self._spreadsheets.get(spreadsheet_key)
+        if spreadsheet is None:
+            client = self.get_client()
+            if self.sheet_key:
+                logger.debug(f'[Opening sheet]: Sheet key: {self.sheet_key}')
+                spreadsheet = client.open_by_key(self.sheet_key)
+            else:
+                # Opening by title is a Drive search; the key avoids it
+                spreadsheet = client.open(self.sheet_title)
+                logger.info(f'[Opening sheet]: Sheet "{self.sheet_title}" has key {spreadsheet.id}, set it to skip the title lookup')
+            with self._lock:
+                spreadsheet = self._spreadsheets.setdefault(spreadsheet_key, spreadsheet)
+        return spreadsheet
+
     def get_google_sheet(self):
         try:
-            # Authorize gspread with the credentials
-            credentials = self.__authenticate_service_account()
-            client = authorize(credentials=credentials)
-            # Open the Google Sheet by its title
-            logger.debug(f'[Opening sheet]: Sheet: {self.sheet_title}\t{self.worksheet_name}')
-            sheet = client.open(self.sheet_title).worksheet(self.worksheet_name)
-
-            return sheet
+            logger.debug(f'[Opening sheet]: Sheet: {self.sheet_key or self.sheet_title}\t{self.worksheet_name}')
+            return self.get_spreadsheet().worksheet(self.worksheet_name)
         except gspread.exceptions.SpreadsheetNotFound:
             logger.error(f'[Opening sheet]: Not found')
             raise
         except Exception as e:
-            logger.error('f[Opening sheet]: Failed: {e}')
-            raise
\ No newline at end of file
+            logger.error(f'[Opening sheet]: Failed: {e}')
+            raise
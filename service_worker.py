@@ -1,58 +1,362 @@
 import asyncio
+import time
 from service_adapter import ServiceUpdater, ServiceReader
 from sqlite_adapter import SQLiteAdapter
 import sqlite3
-from typing import Dict
+from typing import Any, Dict, Optional
 from target_parser import TargetParser
-from models import Transaction
+from models import TransactionRecord
 from settings import logger
+from sheet_sync import SheetSync
+from sinks import OutputSink, publish_all
+from tracing import CycleProfiler
+from utils import shard_of
+import metrics
+import tracing
+
+# Marks the end of a stage's input
+_DONE = None
+# feed_state key of the contract-wide txns feed
+FEED_NAME = 'txns'
+
 
 class ServiceWorker:
-    def __init__(self, 
+    """Runs parsing cycles as a pipeline of stages connected by bounded queues:
+
+    reader -> fetchers -> serializer -> SQLite batch writer -> output sinks
+
+    A full queue blocks the stage feeding it, so memory stays bounded by the
+    queue sizes rather than by the number of accounts. The output sheet is
+    one sink among `sinks`, each published at its own cadence. Without a
+    service_updater the worker only fills SQLite and the extra sinks, leaving
+    the sheet to a ShardMerger.
+
+    Every cycle is checkpointed in SQLite account by account, so a cycle cut
+    short by a crash or an exception resumes with only the outstanding
+    accounts.
+
+    With 'priority' scheduling a cycle runs every schedule_tick seconds over
+    the accounts whose next refresh is due, soonest first; each refreshed
+    account is rescheduled by how close its age is to claim_period.
+
+    In 'feed' ingest mode only accounts that appear in the contract-wide txns
+    feed since the persisted cursor, or are new or changed in the read sheet,
+    go through the pipeline; the rest only get their age recomputed.
+    """
+    def __init__(self,
                  parser: TargetParser,
-                 service_updater: ServiceUpdater, 
+                 service_updater: Optional[ServiceUpdater],
                  service_reader: ServiceReader,
                  sqlite_adapter: SQLiteAdapter,
-                 timeout: int = 3600):
-        self.__updater = service_updater
+                 timeout: int = 3600,
+                 concurrency: int = 1,
+                 incremental: bool = True,
+                 queue_size: int = 100,
+                 sheet_sync_interval: float = 60,
+                 shard: Optional[tuple[int, int]] = None,
+                 ingest_mode: str = 'poll',
+                 feed_per_page: int = 100,
+                 feed_max_pages: int = 20,
+                 feed_full_refresh_interval: float = 86400,
+                 account_retries: int = 2,
+                 resume_delay: float = 60,
+                 scheduling: str = 'sweep',
+                 schedule_tick: float = 60,
+                 schedule_batch: int = 1000,
+                 refresh_min_interval: float = 300,
+                 refresh_max_interval: float = 21600,
+                 refresh_factor: float = 0.5,
+                 sinks: Optional[list[OutputSink]] = None,
+                 sheet_publish_interval: float = 0,
+                 profiler: Optional[CycleProfiler] = None):
+        self.__sinks: list[OutputSink] = [SheetSync(service_updater, sqlite_adapter, sheet_publish_interval)] if service_updater is not None else []
+        self.__sinks += sinks or []
         self.__reader = service_reader
         self.__sqlite_adapter = sqlite_adapter
         self.__parser = parser
+        self.__profiler = profiler
         self.__contract_name = 'game.hot.tg'
         self.timeout = timeout
+        self.concurrency = concurrency
+        self.incremental = incremental
+        self.queue_size = queue_size
+        self.sheet_sync_interval = sheet_sync_interval
+        # (index, count): process only accounts whose stable hash falls into this shard
+        self.shard = shard
+        self.ingest_mode = ingest_mode
+        self.feed_per_page = feed_per_page
+        self.feed_max_pages = feed_max_pages
+        self.feed_full_refresh_interval = feed_full_refresh_interval
+        self.account_retries = account_retries
+        # Pause before resuming a cycle that raised, instead of waiting out the full timeout
+        self.resume_delay = resume_delay
+        if scheduling == 'priority' and not incremental:
+            logger.warning('[Runtime] Priority scheduling needs incremental sync, falling back to full sweeps')
+            scheduling = 'sweep'
+        self.scheduling = scheduling
+        self.schedule_tick = schedule_tick
+        self.schedule_batch = schedule_batch
+        self.refresh_min_interval = refresh_min_interval
+        self.refresh_max_interval = refresh_max_interval
+        self.refresh_factor = refresh_factor
 
     async def run(self):
         logger.info('[Runtime] Starting infinite loop')
-        while True:
+        async with self.__parser:
+            while True:
+                started = time.perf_counter()
+                # A priority cycle takes only the accounts that are due, so it runs every tick
+                delay = self.schedule_tick if self.scheduling == 'priority' else self.timeout
+                try:
+                    await self.run_cycle()
+                    duration = time.perf_counter() - started
+                    metrics.cycle_duration.observe(duration)
+                    metrics.last_cycle_duration.set(duration)
+                    logger.info(f'[Runtime] Cycle finished in {duration:.1f}s')
+                except Exception as e:
+                    logger.error(f'[RUNTIME] An error occured: {e}')
+                    delay = min(self.timeout, self.resume_delay)
+                finally:
+                    await asyncio.sleep(delay)
+
+    async def run_cycle(self):
+        """Runs a cycle to the end, resuming the last one from its checkpoint if it did not finish.
+
+        Accounts that fail are retried in up to account_retries further passes;
+        those still failing keep their previous row and are left for the next cycle.
+        With a profiler the cycle runs under it.
+        """
+        if self.__profiler is None:
+            await self.__run_cycle()
+        else:
+            with self.__profiler.profile():
+                await self.__run_cycle()
+        tracing.flush()
+
+    async def __run_cycle(self):
+        cycle = self.__sqlite_adapter.get_open_cycle()
+        if cycle is None:
+            cycle = await self.__start_cycle()
+        else:
+            logger.info(f'[Runtime] Resuming cycle {cycle["id"]}')
+        cycle_id, now = cycle['id'], cycle['started_at']
+
+        for attempt in range(self.account_retries + 1):
+            rows = self.__sqlite_adapter.outstanding_accounts(cycle_id, self.account_retries)
+            if not rows:
+                break
+            if attempt:
+                logger.info(f'[Runtime] Retrying {len(rows)} failed accounts (pass {attempt + 1})')
+            await self.__run_pipeline(cycle_id, rows, now)
+
+        freed_rows = self.__sqlite_adapter.delete_missing(self.__sqlite_adapter.cycle_accounts(cycle_id))
+        publish_all(self.__sinks, freed_rows, rebuild=not self.incremental)
+
+        if cycle['feed_event_index'] is not None:
+            self.__sqlite_adapter.save_feed_state(FEED_NAME, cycle['feed_event_index'], cycle['feed_refreshed_at'])
+        # Accounts left failed back off once per cycle, whatever the number of retry passes
+        failure_backoff = (self.refresh_min_interval, self.refresh_max_interval) if self.scheduling == 'priority' else None
+        failed = self.__sqlite_adapter.finish_cycle(cycle_id, time.time(), failure_backoff)
+        metrics.failed_accounts.set(failed)
+        if failed:
+            logger.warning(f'[Runtime] {failed} accounts could not be fetched in cycle {cycle_id}')
+
+    async def __start_cycle(self) -> sqlite3.Row:
+        """Reads the accounts of this shard and checkpoints them as a new cycle."""
+        if not self.incremental:
+            self.__sqlite_adapter.truncate()
+        # One reference time for every age computed in this cycle, kept when it is resumed
+        now = time.time()
+        rows = [row for row in self.__reader.read_columns_generator() if self.__in_shard(row[0])]
+        selected, feed_state = None, None
+        if self.ingest_mode == 'feed':
+            selected, feed_state = await self.__select_from_feed(rows, now)
+        if self.scheduling == 'priority':
+            rows, due = self.__prioritize(rows, now)
+            if self.ingest_mode != 'feed':
+                selected = due
+            elif selected is not None:
+                selected |= due
+        if selected is not None:
+            # Accounts left out are not refetched, but their age still moves on
+            aged = self.__sqlite_adapter.refresh_ages(now)
+            logger.info(f'[Runtime] {len(selected)} of {len(rows)} accounts selected, {aged} ages updated')
+        cycle = self.__sqlite_adapter.start_cycle(now, rows, selected, feed_state)
+        logger.info(f'[Runtime] Cycle {cycle["id"]} started over {len(rows)} accounts')
+        return cycle
+
+    def __prioritize(self, rows: list[list[str]], now: float) -> tuple[list[list[str]], set[str]]:
+        """Orders rows by next refresh time, unscheduled ones first, and picks up to schedule_batch due accounts."""
+        schedule = self.__sqlite_adapter.read_schedule()
+        rows = sorted(rows, key=lambda row: schedule.get(row[0], 0))
+        due = [row[0] for row in rows if schedule.get(row[0], 0) <= now]
+        if self.schedule_batch:
+            due = due[:self.schedule_batch]
+        return rows, set(due)
+
+    async def __run_pipeline(self, cycle_id: int, rows: list, now: float):
+        accounts_queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        parsed_queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        serialized_queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        committed_queue: asyncio.Queue = asyncio.Queue()
+
+        fetchers = [asyncio.create_task(self.__fetch_stage(cycle_id, accounts_queue, parsed_queue))
+                    for _ in range(self.concurrency)]
+        serializer = asyncio.create_task(self.__serialize_stage(cycle_id, parsed_queue, serialized_queue, now))
+        db_writer = asyncio.create_task(self.__db_write_stage(cycle_id, serialized_queue, committed_queue))
+        publisher = asyncio.create_task(self.__publish_stage(committed_queue))
+        try:
+            await self.__read_stage(accounts_queue, rows)
+            for _ in fetchers:
+                await accounts_queue.put(_DONE)
+            await asyncio.gather(*fetchers)
+            await parsed_queue.put(_DONE)
+            await serializer
+            await serialized_queue.put(_DONE)
+            await db_writer
+            await committed_queue.put(_DONE)
+            await publisher
+        except BaseException:
+            await self.__drain(fetchers, serializer, parsed_queue, serialized_queue, db_writer)
+            publisher.cancel()
+            raise
+
+    async def __drain(self, fetchers: list[asyncio.Task], serializer: asyncio.Task, parsed_queue: asyncio.Queue,
+                      serialized_queue: asyncio.Queue, db_writer: asyncio.Task):
+        """Stops fetching and persists whatever has already been fetched."""
+        for fetcher in fetchers:
+            fetcher.cancel()
+        await asyncio.gather(*fetchers, return_exceptions=True)
+        for stage, queue in ((serializer, parsed_queue), (db_writer, serialized_queue)):
+            if stage.done():
+                continue
+            if db_writer.done():
+                # Nobody would consume the serializer's output anymore
+                stage.cancel()
+            else:
+                await queue.put(_DONE)
+            await asyncio.wait([stage])
+        logger.info('[Runtime] Pipeline drained')
+
+    def __in_shard(self, account: str) -> bool:
+        return self.shard is None or shard_of(account, self.shard[1]) == self.shard[0]
+
+    async def __read_stage(self, accounts_queue: asyncio.Queue, rows: list):
+        for row in rows:
+            await accounts_queue.put(row)
+        logger.info(f'[Runtime] {len(rows)} accounts queued')
+
+    async def __select_from_feed(self, rows: list[list[str]], now: float) -> tuple[Optional[set[str]], tuple[str, float]]:
+        """Picks the accounts to refetch in feed mode and the feed state to save once the cycle succeeds.
+
+        Returns None instead of a set when every account has to be refetched: on
+        the first cycle, when the backlog exceeds feed_max_pages and every
+        feed_full_refresh_interval, so that NEAR balance changes made outside
+        the contract are picked up too. Accounts the previous cycle failed to
+        fetch are selected again, since their events are behind the cursor.
+        """
+        state = self.__sqlite_adapter.get_feed_state(FEED_NAME)
+        cursor, refreshed_at = state if state is not None else (None, 0.0)
+        full_refresh = not self.incremental or now - refreshed_at >= self.feed_full_refresh_interval
+        with tracing.root('feed', full_refresh=full_refresh):
+            events, head, complete = await self.__parser.fetch_feed_events(None if full_refresh else cursor,
+                                                                           self.feed_max_pages, self.feed_per_page)
+        if not complete:
+            logger.info('[Runtime] Feed: full refresh')
+            # An empty feed still gets a cursor: any event after it is new
+            return None, (head or '0', now)
+
+        watched = {row[0] for row in rows}
+        affected = {account for event in events
+                    for account in (event.get('affected_account_id'), event.get('involved_account_id'))
+                    if account in watched}
+        stored = self.__sqlite_adapter.read_claim_periods()
+        changed = {row[0] for row in rows if row[0] not in stored or stored[row[0]] != _claim_period(row[1])}
+        unfinished = self.__sqlite_adapter.unfinished_accounts() & watched
+        logger.info(f'[Runtime] Feed: {len(events)} new events, {len(affected)} affected, '
+                    f'{len(changed)} new or changed and {len(unfinished)} previously failed accounts')
+        return affected | changed | unfinished, (head, refreshed_at)
+
+    async def __fetch_stage(self, cycle_id: int, accounts_queue: asyncio.Queue, parsed_queue: asyncio.Queue):
+        while (row := await accounts_queue.get()) is not _DONE:
             try:
-                self.__sqlite_adapter.truncate()
-                for item in self.__reader.read_columns_generator():
-                    await self.__item_iter_func(item)
-                    await asyncio.sleep(3)
-                
-                self.__updater.clear()
-                for rows in self.__sqlite_adapter.read_all():
-                    self.__updater.append_rows(rows)
-                self.__updater.update_last_updated()
+                await parsed_queue.put(await self.__fetch_account(row))
             except Exception as e:
-                logger.error(f'[RUNTIME] An error occured: {e}')
-            finally:
-                await asyncio.sleep(self.timeout)
+                logger.error(f'[Runtime iteration] An error occured while processing {row[0]}: {e}')
+                self.__sqlite_adapter.mark_failed(cycle_id, row[0], str(e))
 
-    
-    async def __item_iter_func(self, row: list[str]): 
+    async def __fetch_account(self, row: list[str]) -> tuple[dict[str, Any], bool]:
         item = row[0]
-        additional_params = {'claim_period': row[1]}
-        logger.info(f'[Runtime iteration] Proccessing account: {item}')
+        logger.debug('[Runtime iteration] Proccessing account: %s', item)
         query_params = {'a': item, 'contract_name': self.__contract_name}
-        data = await self.__parser.parse(query_params)
-        transaction = self.__parser.serialize({**data, **additional_params})
-        self.__sqlite_adapter.upsert_one(transaction.name,
-                                         hash=transaction.hash,
-                                         quantity=transaction.quantity,
-                                         age=transaction.age,
-                                         near_amount=transaction.near_amount,
-                                         hot_amount=transaction.hot_amount,
-                                         claim_period=transaction.claim_period)
+        with tracing.account(item):
+            known_txn = self.__sqlite_adapter.get_first_mint(item)
+            data = await self.__parser.parse(query_params, known_txn=known_txn)
+        is_new_mint = known_txn is None and bool(data.get('transaction_hash')) and data.get('block_timestamp') is not None
+        data['claim_period'] = row[1]
+        return data, is_new_mint
+
+    async def __serialize_stage(self, cycle_id: int, parsed_queue: asyncio.Queue, serialized_queue: asyncio.Queue, now: float):
+        """Serializes whatever has been parsed so far in one pass, up to db_recordset_size accounts at a time.
+
+        Accounts whose result cannot be serialized are checkpointed as failed, like fetch errors.
+        """
+        done = False
+        while not done:
+            batch = [await parsed_queue.get()]
+            while len(batch) < self.__sqlite_adapter.db_recordset_size and not parsed_queue.empty():
+                batch.append(parsed_queue.get_nowait())
+            if batch[-1] is _DONE:
+                batch.pop()
+                done = True
+            if batch:
+                failed: dict[str, str] = {}
+                with tracing.root('serialize', accounts=len(batch)):
+                    records = self.__parser.serialize_many([data for data, _ in batch], now, failed)
+                for name, error in failed.items():
+                    self.__sqlite_adapter.mark_failed(cycle_id, name, error)
+                await serialized_queue.put((records, [data for data, is_new_mint in batch if is_new_mint]))
+
+    async def __db_write_stage(self, cycle_id: int, serialized_queue: asyncio.Queue, committed_queue: asyncio.Queue):
+        """Writes serialized results to SQLite and checkpoints their accounts, one transaction per db_recordset_size batch."""
+        transactions: list[TransactionRecord] = []
+        first_mints: list[dict] = []
+
+        def flush():
+            with tracing.root('db_write', rows=len(transactions), first_mints=len(first_mints)):
+                if first_mints:
+                    self.__sqlite_adapter.save_first_mints(first_mints)
+                if transactions and self.__sqlite_adapter.upsert_many(transactions, cycle_id):
+                    if self.scheduling == 'priority':
+                        self.__sqlite_adapter.schedule_refresh((t.name for t in transactions), time.time(), self.refresh_min_interval,
+                                                               self.refresh_max_interval, self.refresh_factor)
+                    committed_queue.put_nowait(len(transactions))
+            transactions.clear()
+            first_mints.clear()
+
+        try:
+            while (item := await serialized_queue.get()) is not _DONE:
+                records, new_mints = item
+                transactions.extend(records)
+                first_mints.extend(new_mints)
+                if len(transactions) >= self.__sqlite_adapter.db_recordset_size:
+                    flush()
+        finally:
+            flush()
+
+    async def __publish_stage(self, committed_queue: asyncio.Queue):
+        """Publishes committed rows while the cycle is still running, at most once per sheet_sync_interval."""
+        loop = asyncio.get_running_loop()
+        last_sync = loop.time()
+        while await committed_queue.get() is not _DONE:
+            if self.__sinks and self.incremental and loop.time() - last_sync >= self.sheet_sync_interval:
+                publish_all(self.__sinks, [])
+                last_sync = loop.time()
 
 
+def _claim_period(value: str) -> Optional[int]:
+    """claim_period of a read sheet row as it is stored in SQLite, where unparsable values are NULL."""
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
@@ -1,11 +1,12 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
 import logging
 from logging.handlers import RotatingFileHandler
-import sqlite3
-from typing import Dict
+from functools import lru_cache
+from typing import Dict, Literal, Optional
 
 class Settings(BaseSettings):
-    model_config = SettingsConfigDict(env_prefix='',  validate_default=False)
+    # Blank keys (as in example.env) fall back to the defaults instead of failing to parse
+    model_config = SettingsConfigDict(env_prefix='',  validate_default=False, env_ignore_empty=True)
     scopes: list[str] = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
     service_account_file: str
     log_path: str
@@ -18,30 +19,123 @@ class Settings(BaseSettings):
     write_worksheet_name: str
     read_sheet_name: str
     write_sheet_name: str
+    # Spreadsheet keys (the id in the sheet URL) skip the Drive search by title
+    read_sheet_key: Optional[str] = None
+    write_sheet_key: Optional[str] = None
     db_recordset_size: int
     timeout: int
     log_max_bytes: int = 5*1024*1024
     parsing_depth: int
+    scan_order: Literal['asc', 'desc'] = 'asc'
+    prefetch_pages: int = 3
+    per_page: int = 25
+    concurrency: int = 4
+    requests_per_second: float = 3
+    connection_limit: int = 10
+    incremental_sync: bool = True
+    queue_size: int = 100
+    sheet_sync_interval: float = 60
+    sqlite_synchronous: str = 'NORMAL'
+    metrics_host: str = '127.0.0.1'
+    # 0 disables metrics; shard N serves them on metrics_port + N + 1
+    metrics_port: int = 9108
+    api_keys: list[str] = []
+    shard_count: int = 1
+    # 'local' runs every shard as a child process plus the merger; 'shard' (with shard_index) and
+    # 'merger' split them across deployments sharing the SQLite directory
+    shard_role: Literal['local', 'shard', 'merger'] = 'local'
+    shard_index: int = 0
+    merge_interval: float = 300
+    max_retries: int = 5
+    backoff_base: float = 1.0
+    backoff_max: float = 60.0
+    # Seconds a cached account/inventory response is served without asking the API; 0 disables caching
+    http_cache_ttls: Dict[str, float] = {'account': 300, 'inventory': 300}
+    # Entries kept in memory; each account takes two (account and inventory), so keep it at least twice the account count
+    http_cache_size: int = 50000
+    # SQLite file that keeps cached responses across restarts; empty keeps them in memory only
+    http_cache_path: str = ''
+    # Extra passes over the accounts that failed in a cycle before they are left for the next one
+    account_retries: int = 2
+    # Seconds to wait before resuming a cycle that was aborted by an error
+    resume_delay: float = 60
+    # 'sweep' refreshes every account each cycle; 'priority' refreshes, every schedule_tick seconds, only the
+    # accounts that are due, soonest first, rescheduling each by how close its age is to claim_period
+    scheduling: Literal['sweep', 'priority'] = 'sweep'
+    schedule_tick: float = 60
+    # Accounts refreshed per tick at most, 0 for no limit
+    schedule_batch: int = 1000
+    refresh_min_interval: float = 300
+    refresh_max_interval: float = 21600
+    # Share of the hours left between age and claim_period to wait before the next refresh
+    refresh_factor: float = 0.5
+    # Seconds between publishes to the output sheet, 0 publishes after every cycle; rows freed by
+    # removed accounts are always published at once
+    sheet_publish_interval: float = 0
+    # CSV or Parquet (by extension, Parquet needs pyarrow) export of the table; empty disables it
+    output_file_path: str = ''
+    output_file_interval: float = 0
+    # Read-only JSON endpoint over SQLite (GET /accounts, /accounts/{name}); port 0 disables it
+    api_host: str = '127.0.0.1'
+    api_port: int = 0
+    # Span trace of the parse path: JSONL file if the path ends in .jsonl, SQLite file otherwise; empty disables it
+    trace_path: str = ''
+    # Accounts to trace, empty for all of them
+    trace_accounts: list[str] = []
+    # 'cprofile' or 'yappi' runs every cycle under that profiler and saves pstats files to profile_dir; empty disables it
+    profiler: str = ''
+    profile_dir: str = 'profiles'
+    # JSON decoder of API responses: 'auto' picks msgspec, orjson or the stdlib json, whichever is installed first
+    json_backend: Literal['auto', 'msgspec', 'orjson', 'json'] = 'auto'
+    # 'poll' queries the txns of every watched account each cycle; 'feed' tails the contract-wide
+    # txns feed and refetches only the accounts that appear in it
+    ingest_mode: Literal['poll', 'feed'] = 'poll'
+    feed_per_page: int = 100
+    # Feed pages read per cycle at most; a longer backlog falls back to a full refresh
+    feed_max_pages: int = 20
+    # Seconds between full refreshes in feed mode, which pick up NEAR balance changes outside the contract
+    feed_full_refresh_interval: float = 86400
     db_schemas: Dict[str, str] = {
         'create_schema': './schemas/create_schema.sql',
         'insert_one': './schemas/insert_one_schema.sql',
+        'upsert_many': './schemas/upsert_many.sql',
+        'merge_shard': './schemas/merge_shard.sql',
+        'refresh_ages': './schemas/refresh_ages.sql',
+        'schedule_refresh': './schemas/schedule_refresh.sql',
+        'schedule_failure': './schemas/schedule_failure.sql',
         'read_all': './schemas/read_all.sql'
         }
-settings = Settings(_env_file = '.env', _env_file_encoding = 'utf-8', _case_sensitive = False) # type: ignore
 
 
-handler = RotatingFileHandler(settings.log_path, maxBytes=5*1024*1024, backupCount=5)  # 5MB, сохраняем до 5 старых файлов
-handler.setLevel(settings.log_level)
+logger = logging.getLogger(__name__)
 
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
 
-logging.basicConfig(
-    level=settings.log_level,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[handler]
-)
+def configure_logging(settings: Settings, log_path: Optional[str] = None):
+    """Logs to `log_path` (settings.log_path by default), replacing the handlers configured before."""
+    handler = RotatingFileHandler(log_path or settings.log_path, maxBytes=settings.log_max_bytes, backupCount=5)  # сохраняем до 5 старых файлов
+    handler.setLevel(settings.log_level)
+
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handler.setFormatter(formatter)
+
+    logging.basicConfig(
+        level=settings.log_level,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[handler],
+        force=True
+    )
+
+
+@lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    """Loads settings from the environment and .env on first use and configures logging."""
+    settings = Settings(_env_file = '.env', _env_file_encoding = 'utf-8', _case_sensitive = False) # type: ignore
+    configure_logging(settings)
+    return settings
 
-logger = logging.getLogger(__name__)
 
-conn = sqlite3.connect(settings.sqlite_path)
\ No newline at end of file
+def __getattr__(name: str):
+    # Keeps `from settings import settings` working while deferring the load until it is needed
+    if name == 'settings':
+        return get_settings()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,54 @@
+import asyncio
+import multiprocessing
+from typing import Optional
+from service_adapter import ServiceUpdater, ServiceReader
+from sqlite_adapter import SQLiteAdapter
+from sheet_sync import SheetSync
+from sinks import OutputSink, publish_all
+from settings import logger
+import tracing
+
+
+class ShardMerger:
+    """Publishes the combined result of sharded workers.
+
+    Each shard worker fills its own SQLite file; the merger folds them into
+    its own database and publishes the changed rows to the sheet and `sinks`.
+    With `shard_processes` (local shards) the merger stops as soon as one of
+    them exits, instead of publishing its rows as if they were still fresh.
+    """
+    def __init__(self,
+                 service_updater: ServiceUpdater,
+                 service_reader: ServiceReader,
+                 sqlite_adapter: SQLiteAdapter,
+                 shard_paths: list[str],
+                 merge_interval: float = 300,
+                 sinks: Optional[list[OutputSink]] = None,
+                 sheet_publish_interval: float = 0,
+                 shard_processes: Optional[list[multiprocessing.Process]] = None):
+        self.__reader = service_reader
+        self.__sqlite_adapter = sqlite_adapter
+        self.__sinks: list[OutputSink] = [SheetSync(service_updater, sqlite_adapter, sheet_publish_interval)]
+        self.__sinks += sinks or []
+        self.shard_paths = shard_paths
+        self.merge_interval = merge_interval
+        self.shard_processes = shard_processes or []
+
+    async def run(self):
+        logger.info(f'[ShardMerger] Merging {len(self.shard_paths)} shards')
+        while True:
+            if dead := [process.name for process in self.shard_processes if not process.is_alive()]:
+                logger.error(f'[ShardMerger] Shard processes exited: {", ".join(dead)}')
+                raise RuntimeError(f'Shard processes exited: {", ".join(dead)}')
+            try:
+                self.merge()
+            except Exception as e:
+                logger.error(f'[ShardMerger] An error occured: {e}')
+            finally:
+                await asyncio.sleep(self.merge_interval)
+
+    def merge(self):
+        accounts = {row[0] for row in self.__reader.read_columns_generator()}
+        self.__sqlite_adapter.merge_from(self.shard_paths)
+        publish_all(self.__sinks, self.__sqlite_adapter.delete_missing(accounts))
+        tracing.flush()
@@ -0,0 +1,45 @@
+from service_adapter import ServiceUpdater
+from sqlite_adapter import SQLiteAdapter
+from settings import logger
+from sinks import OutputSink
+
+
+class SheetSync(OutputSink):
+    """Publishes the 'transactions' table to the output worksheet."""
+    def __init__(self, service_updater: ServiceUpdater, sqlite_adapter: SQLiteAdapter, interval: float = 0):
+        super().__init__(interval)
+        self.__updater = service_updater
+        self.__sqlite_adapter = sqlite_adapter
+
+    def publish(self, freed_rows: list[int]):
+        """Pushes only rows changed since the last publish to the sheet.
+
+        Freed rows are taken from SQLite rather than from `freed_rows`: rows
+        whose deletion failed before are deleted first, so that no row is
+        written to a position that is only valid once they are gone.
+        """
+        if not self.__sqlite_adapter.has_placed_rows():
+            # Nothing has been placed yet: the sheet may hold rows of a full rebuild
+            self.__updater.clear()
+            self.__sqlite_adapter.clear_freed_rows()
+        freed_rows, last_freed = self.__sqlite_adapter.read_freed_rows()
+        if freed_rows:
+            self.__updater.delete_rows(freed_rows)
+            self.__sqlite_adapter.clear_freed_rows(last_freed)
+        synced = []
+        for rows in self.__sqlite_adapter.read_changed(self.__updater.num_header_rows + 1):
+            self.__updater.update_rows(rows)
+            synced += rows
+        self.__updater.update_last_updated()
+        self.__updater.flush(self.__sqlite_adapter.count())
+        self.__sqlite_adapter.mark_synced(synced)
+        logger.info(f'[SheetSync] {len(synced)} changed rows synced, {len(freed_rows)} removed')
+
+    def rebuild(self):
+        """Clears the sheet and writes every row again."""
+        self.__updater.clear()
+        self.__sqlite_adapter.clear_freed_rows()
+        for rows in self.__sqlite_adapter.read_all():
+            self.__updater.append_rows(rows)
+        self.__updater.update_last_updated()
+        self.__updater.flush(self.__sqlite_adapter.count())
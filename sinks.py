@@ -0,0 +1,110 @@
+import csv
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Optional
+from models import TransactionRecord
+from sqlite_adapter import SQLiteAdapter
+from settings import logger
+import tracing
+
+# Columns written by sinks that export the table as is
+EXPORT_COLUMNS = TransactionRecord._fields
+
+
+class OutputSink(ABC):
+    """Destination of the 'transactions' table.
+
+    `publish` is called after the rows of a cycle are committed, at most once
+    per `interval` seconds, with the sheet rows (bottom first) freed by
+    accounts deleted since the previous call. Freed rows are always delivered
+    right away, whatever the interval, since the positions of the remaining
+    rows have already shifted.
+    """
+    def __init__(self, interval: float = 0):
+        self.interval = interval
+        self.__published_at: Optional[float] = None
+
+    def due(self, now: float) -> bool:
+        return self.__published_at is None or now - self.__published_at >= self.interval
+
+    def published(self, now: float):
+        self.__published_at = now
+
+    @abstractmethod
+    def publish(self, freed_rows: list[int]):
+        ...
+
+    def rebuild(self):
+        """Writes the whole table again, as after a truncate."""
+        self.publish([])
+
+
+def publish_all(sinks: list[OutputSink], freed_rows: list[int], rebuild: bool = False):
+    """Publishes to every sink that is due; a failing sink is logged and does not hold back the others."""
+    now = time.monotonic()
+    for sink in sinks:
+        if not (rebuild or freed_rows or sink.due(now)):
+            continue
+        try:
+            with tracing.root('publish', sink=type(sink).__name__, rebuild=rebuild, freed_rows=len(freed_rows)):
+                if rebuild:
+                    sink.rebuild()
+                else:
+                    sink.publish(freed_rows)
+            sink.published(now)
+        except Exception as e:
+            logger.error(f'[Runtime] An error occured while publishing to {type(sink).__name__}: {e}')
+
+
+class FileSink(OutputSink):
+    """Exports the table to a CSV or Parquet file, streamed in chunks of db_recordset_size rows.
+
+    The file is written next to `path` and moved over it once complete, so
+    readers never see a partial export. Nothing is written while the table is
+    unchanged. Parquet needs pyarrow.
+    """
+    def __init__(self, sqlite_adapter: SQLiteAdapter, path: str, format: Optional[str] = None, interval: float = 0):
+        super().__init__(interval)
+        self.__sqlite_adapter = sqlite_adapter
+        self.path = path
+        self.format = format or ('parquet' if path.endswith('.parquet') else 'csv')
+        if self.format not in ('csv', 'parquet'):
+            raise ValueError(f'Unknown output file format: {self.format}')
+        self.__fingerprint = None
+
+    def publish(self, freed_rows: list[int]):
+        fingerprint = self.__sqlite_adapter.fingerprint()
+        if fingerprint == self.__fingerprint and os.path.exists(self.path):
+            return
+        tmp_path = f'{self.path}.tmp'
+        rows = self.__write_parquet(tmp_path) if self.format == 'parquet' else self.__write_csv(tmp_path)
+        os.replace(tmp_path, self.path)
+        self.__fingerprint = fingerprint
+        logger.info(f'[FileSink] {rows} rows exported to {self.path}')
+
+    def __write_csv(self, path: str) -> int:
+        rows = 0
+        with open(path, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(EXPORT_COLUMNS)
+            for chunk in self.__sqlite_adapter.read_export(EXPORT_COLUMNS):
+                writer.writerows(chunk)
+                rows += len(chunk)
+        return rows
+
+    def __write_parquet(self, path: str) -> int:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([('name', pa.string()), ('hash', pa.string()), ('quantity', pa.float64()),
+                            ('near_amount', pa.float64()), ('hot_amount', pa.float64()),
+                            ('age', pa.int64()), ('claim_period', pa.int64())])
+        rows = 0
+        with pq.ParquetWriter(path, schema) as writer:
+            for chunk in self.__sqlite_adapter.read_export(EXPORT_COLUMNS):
+                columns = list(zip(*chunk))
+                writer.write_table(pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                                                        schema=schema))
+                rows += len(chunk)
+        return rows
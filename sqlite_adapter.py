@@ -1,9 +1,20 @@
+import os
 import sqlite3
 from utils import read_sql_file
-from typing import Dict
+from typing import Any, Dict, Iterable, Optional
 from settings import logger
-from models import Transaction
+from models import TransactionRecord
+import metrics
+
 class SQLiteAdapter:
+    # Columns added after the initial schema; created on existing databases by init_db
+    migrated_columns = {
+        'version': 'INTEGER NOT NULL DEFAULT 1',
+        'synced_version': 'INTEGER NOT NULL DEFAULT 0',
+        'sheet_row': 'INTEGER',
+        # Bumped like version, but not when only the age moved on
+        'data_version': 'INTEGER NOT NULL DEFAULT 1',
+    }
 
     def __init__(self, sqlite_conn: sqlite3.Connection, schemas: Dict[str, str], db_recordset_size: int):
         self.db_recordset_size = db_recordset_size;
@@ -16,67 +27,326 @@ class SQLiteAdapter:
         try:
             logger.info('[SQLiteAdapter] Initializing database')
             sql_query = read_sql_file(self.__schemas['create_schema'])
-            self.__cursor.execute(sql_query)
+            self.__cursor.executescript(sql_query)
+            self.__migrate()
             self.__sqlite_conn.commit()
         except Exception as e:
             self.__sqlite_conn.rollback()
             logger.error(f'[SQLiteAdapter] An error occured while initializing database: {e}')
     
+    def __migrate(self):
+        self.__cursor.execute("PRAGMA table_info(transactions)")
+        existing = {row[1] for row in self.__cursor.fetchall()}
+        for column, definition in self.migrated_columns.items():
+            if column not in existing:
+                self.__cursor.execute(f"ALTER TABLE transactions ADD COLUMN {column} {definition}")
+                logger.info(f"[SQLiteAdapter] Column '{column}' added to 'transactions'")
+
     def truncate(self):
         try:
             self.__cursor.execute("DELETE FROM transactions")
+            self.__cursor.execute("DELETE FROM freed_rows")
             self.__sqlite_conn.commit()
             logger.info("[SQLiteAdapter] Table 'transactions' truncated successfully")
         except sqlite3.Error as e:
             self.__sqlite_conn.rollback()
             logger.error(f"[SQLiteAdapter] Error truncating table: {e}")
 
-    def upsert_one(self, name, hash=None, quantity=None, near_amount=None, hot_amount=None, age=None, claim_period=None):
+    def get_first_mint(self, name: str) -> Optional[dict[str, Any]]:
+        """Returns the cached first MINT transaction of an account, if it was resolved before."""
         try:
-            # Check if the record exists
-            self.__cursor.execute("SELECT id FROM transactions WHERE name = ?", (name,))
+            self.__cursor.execute("SELECT hash, delta_amount, block_timestamp FROM first_mints WHERE name = ?", (name,))
             record = self.__cursor.fetchone()
-            
-            if record:
-                # Update existing record
-                update_fields = []
-                params = []
-                if hash is not None:
-                    update_fields.append("hash = ?")
-                    params.append(hash)
-                if quantity is not None:
-                    update_fields.append("quantity = ?")
-                    params.append(quantity)
-                if near_amount is not None:
-                    update_fields.append("near_amount = ?")
-                    params.append(near_amount)
-                if hot_amount is not None:
-                    update_fields.append("hot_amount = ?")
-                    params.append(hot_amount)
-                if age is not None:
-                    update_fields.append("age = ?")
-                    params.append(age)
-                if claim_period is not None:
-                    update_fields.append("claim_period = ?")
-                    params.append(age)
-                if not update_fields:
-                    logger.warning('[SQLiteAdapter] No fields available for update')
-                    return
-                params.append(name)
-                sql_query = f"UPDATE transactions SET {', '.join(update_fields)} WHERE name = ?"
-                self.__cursor.execute(sql_query, params)
-                logger.info(f'[SQLiteAdapter] Row with name {name} updated')
+            if record is None:
+                return None
+            return {'transaction_hash': record['hash'],
+                    'affected_account_id': name,
+                    'delta_amount': record['delta_amount'],
+                    'block_timestamp': record['block_timestamp']}
+        except sqlite3.Error as e:
+            logger.error(f'[SQLiteAdapter] An error occurred while reading first mint of {name}: {e}')
+            return None
+
+    def save_first_mints(self, txns: Iterable[dict[str, Any]]):
+        """Caches resolved first MINT transactions; expects parsed txn dicts."""
+        try:
+            self.__cursor.executemany("INSERT OR REPLACE INTO first_mints (name, hash, delta_amount, block_timestamp) VALUES (?, ?, ?, ?)",
+                                      ((txn['affected_account_id'], txn['transaction_hash'], txn.get('delta_amount'), str(txn['block_timestamp']))
+                                       for txn in txns))
+            self.__sqlite_conn.commit()
+        except sqlite3.Error as e:
+            self.__sqlite_conn.rollback()
+            logger.error(f'[SQLiteAdapter] An error occurred while caching first mints: {e}')
+
+    def get_feed_state(self, feed: str) -> Optional[tuple[str, float]]:
+        """Returns the event_index the feed was read up to and the time of the last full refresh."""
+        self.__cursor.execute("SELECT event_index, refreshed_at FROM feed_state WHERE feed = ?", (feed,))
+        record = self.__cursor.fetchone()
+        return (record['event_index'], record['refreshed_at']) if record is not None else None
+
+    def save_feed_state(self, feed: str, event_index: str, refreshed_at: float):
+        try:
+            self.__cursor.execute("INSERT OR REPLACE INTO feed_state (feed, event_index, refreshed_at) VALUES (?, ?, ?)",
+                                  (feed, event_index, refreshed_at))
+            self.__sqlite_conn.commit()
+        except sqlite3.Error as e:
+            self.__sqlite_conn.rollback()
+            logger.error(f'[SQLiteAdapter] An error occurred while saving the cursor of feed {feed}: {e}')
+
+    def read_claim_periods(self) -> dict[str, Optional[int]]:
+        """Stored claim_period of every account, to spot accounts that are new or changed in the read sheet."""
+        self.__cursor.execute("SELECT name, claim_period FROM transactions")
+        return {row['name']: row['claim_period'] for row in self.__cursor.fetchall()}
+
+    def refresh_ages(self, now: float) -> int:
+        """Recomputes the age of accounts with a known first MINT as of `now` (Unix time); returns the number of changed rows."""
+        try:
+            sql_query = read_sql_file(self.__schemas['refresh_ages'])
+            with metrics.sqlite_batch_duration.time():
+                self.__cursor.execute(sql_query, {'now': now})
+                self.__sqlite_conn.commit()
+            return self.__cursor.rowcount
+        except sqlite3.Error as e:
+            self.__sqlite_conn.rollback()
+            logger.error(f'[SQLiteAdapter] An error occurred while refreshing ages: {e}')
+            return 0
+
+    def upsert_many(self, transactions: list[TransactionRecord], cycle_id: Optional[int] = None) -> bool:
+        """Upserts a batch of rows in one transaction, bumping versions only of rows whose values changed.
+
+        With `cycle_id` the accounts are checkpointed as done in the same transaction.
+        """
+        try:
+            sql_query = read_sql_file(self.__schemas['upsert_many'])
+            with metrics.sqlite_batch_duration.time():
+                # Records are tuples in parameter order and are bound as they are
+                self.__cursor.executemany(sql_query, transactions)
+                logger.debug(f'[SQLiteAdapter] {self.__cursor.rowcount} rows inserted or changed')
+                if cycle_id is not None:
+                    self.__cursor.executemany("UPDATE cycle_accounts SET status = 'done', error = NULL WHERE cycle_id = ? AND name = ?",
+                                              ((cycle_id, t.name) for t in transactions))
+                self.__sqlite_conn.commit()
+            return True
+        except Exception as e:
+            self.__sqlite_conn.rollback()
+            logger.error(f'[SQLiteAdapter] An error occurred while upserting a batch: {e}')
+            return False
+
+    def read_schedule(self) -> dict[str, float]:
+        """next_refresh_at of every scheduled account."""
+        self.__cursor.execute("SELECT name, next_refresh_at FROM schedule")
+        return {row['name']: row['next_refresh_at'] for row in self.__cursor.fetchall()}
+
+    def schedule_refresh(self, names: Iterable[str], now: float, min_interval: float, max_interval: float, factor: float):
+        """Schedules the next refresh of freshly written accounts by how close their age is to claim_period.
+
+        The interval is `factor` of the hours between age and claim_period, halved
+        for rows whose data (not just age) changed since the last refresh and
+        clamped to [min_interval, max_interval].
+        """
+        try:
+            sql_query = read_sql_file(self.__schemas['schedule_refresh'])
+            params = {'now': now, 'min_interval': min_interval, 'max_interval': max_interval, 'factor': factor}
+            self.__cursor.executemany(sql_query, ({**params, 'name': name} for name in names))
+            self.__sqlite_conn.commit()
+        except sqlite3.Error as e:
+            self.__sqlite_conn.rollback()
+            logger.error(f'[SQLiteAdapter] An error occurred while scheduling refreshes: {e}')
+
+    def get_open_cycle(self) -> Optional[sqlite3.Row]:
+        """Returns the last cycle if it has not finished, i.e. the one to resume."""
+        self.__cursor.execute("SELECT * FROM cycles ORDER BY id DESC LIMIT 1")
+        cycle = self.__cursor.fetchone()
+        return cycle if cycle is not None and cycle['finished_at'] is None else None
+
+    def start_cycle(self, started_at: float, rows: Iterable[list[str]], selected: Optional[set[str]] = None,
+                    feed_state: Optional[tuple[str, float]] = None) -> sqlite3.Row:
+        """Checkpoints a new cycle over `rows` (account, claim_period); accounts outside `selected` are recorded as skipped."""
+        try:
+            feed_event_index, feed_refreshed_at = feed_state if feed_state is not None else (None, None)
+            self.__cursor.execute("INSERT INTO cycles (started_at, feed_event_index, feed_refreshed_at) VALUES (?, ?, ?)",
+                                  (started_at, feed_event_index, feed_refreshed_at))
+            cycle_id = self.__cursor.lastrowid
+            self.__cursor.executemany("INSERT OR IGNORE INTO cycle_accounts (cycle_id, name, claim_period, status) VALUES (?, ?, ?, ?)",
+                                      ((cycle_id, row[0], row[1], 'pending' if selected is None or row[0] in selected else 'skipped')
+                                       for row in rows))
+            self.__sqlite_conn.commit()
+        except sqlite3.Error as e:
+            self.__sqlite_conn.rollback()
+            logger.error(f'[SQLiteAdapter] An error occurred while starting a cycle: {e}')
+            raise
+        self.__cursor.execute("SELECT * FROM cycles WHERE id = ?", (cycle_id,))
+        return self.__cursor.fetchone()
+
+    def outstanding_accounts(self, cycle_id: int, max_retries: int) -> list[sqlite3.Row]:
+        """(account, claim_period) rows of the cycle still to fetch: pending ones and failed ones with retries left."""
+        self.__cursor.execute("""SELECT name, claim_period FROM cycle_accounts
+                                 WHERE cycle_id = ? AND (status = 'pending' OR (status = 'failed' AND retries <= ?))
+                                 ORDER BY rowid""", (cycle_id, max_retries))
+        return self.__cursor.fetchall()
+
+    def cycle_accounts(self, cycle_id: int) -> set[str]:
+        self.__cursor.execute("SELECT name FROM cycle_accounts WHERE cycle_id = ?", (cycle_id,))
+        return {row['name'] for row in self.__cursor.fetchall()}
+
+    def unfinished_accounts(self) -> set[str]:
+        """Accounts the last finished cycle could not fetch."""
+        self.__cursor.execute("""SELECT name FROM cycle_accounts
+                                 WHERE status IN ('pending', 'failed')
+                                   AND cycle_id = (SELECT MAX(id) FROM cycles WHERE finished_at IS NOT NULL)""")
+        return {row['name'] for row in self.__cursor.fetchall()}
+
+    def mark_failed(self, cycle_id: int, name: str, error: str):
+        try:
+            self.__cursor.execute("UPDATE cycle_accounts SET status = 'failed', retries = retries + 1, error = ? WHERE cycle_id = ? AND name = ?",
+                                  (error, cycle_id, name))
+            self.__sqlite_conn.commit()
+        except sqlite3.Error as e:
+            self.__sqlite_conn.rollback()
+            logger.error(f'[SQLiteAdapter] An error occurred while checkpointing failed account {name}: {e}')
+
+    def finish_cycle(self, cycle_id: int, finished_at: float, failure_backoff: Optional[tuple[float, float]] = None) -> int:
+        """Closes the cycle, drops checkpoints of older cycles and returns the number of accounts left failed.
+
+        With `failure_backoff` (min_interval, max_interval) the next refresh of
+        each account left failed is backed off exponentially with its
+        consecutive failed cycles, in the same transaction.
+        """
+        try:
+            self.__cursor.execute("UPDATE cycles SET finished_at = ? WHERE id = ?", (finished_at, cycle_id))
+            if failure_backoff is not None:
+                min_interval, max_interval = failure_backoff
+                self.__cursor.execute(read_sql_file(self.__schemas['schedule_failure']),
+                                      {'cycle_id': cycle_id, 'now': finished_at, 'min_interval': min_interval, 'max_interval': max_interval})
+            self.__cursor.execute("DELETE FROM cycle_accounts WHERE cycle_id < ?", (cycle_id,))
+            self.__cursor.execute("DELETE FROM cycles WHERE id < ?", (cycle_id,))
+            self.__sqlite_conn.commit()
+        except sqlite3.Error as e:
+            self.__sqlite_conn.rollback()
+            logger.error(f'[SQLiteAdapter] An error occurred while finishing cycle {cycle_id}: {e}')
+        self.__cursor.execute("SELECT COUNT(*) FROM cycle_accounts WHERE cycle_id = ? AND status IN ('pending', 'failed')", (cycle_id,))
+        return self.__cursor.fetchone()[0]
+
+    def merge_from(self, shard_paths: Iterable[str]):
+        """Upserts the rows of every shard database into this one, bumping versions of changed rows."""
+        sql_query = read_sql_file(self.__schemas['merge_shard'])
+        for path in shard_paths:
+            if not os.path.exists(path):
+                logger.warning(f'[SQLiteAdapter] Shard {path} does not exist yet')
+                continue
+            try:
+                self.__cursor.execute("ATTACH DATABASE ? AS shard", (path,))
+                try:
+                    with metrics.sqlite_batch_duration.time():
+                        self.__cursor.execute(sql_query)
+                        self.__sqlite_conn.commit()
+                finally:
+                    self.__cursor.execute("DETACH DATABASE shard")
+                logger.debug(f'[SQLiteAdapter] Shard {path} merged')
+            except sqlite3.Error as e:
+                self.__sqlite_conn.rollback()
+                logger.error(f'[SQLiteAdapter] An error occurred while merging shard {path}: {e}')
+
+    def has_placed_rows(self) -> bool:
+        """Whether any row has already been given a position in the output sheet."""
+        self.__cursor.execute("SELECT 1 FROM transactions WHERE sheet_row IS NOT NULL LIMIT 1")
+        return self.__cursor.fetchone() is not None
+
+    def delete_missing(self, names: set[str]) -> list[int]:
+        """Deletes accounts that are not in `names` anymore.
+
+        Returns the sheet rows they occupied (bottom first) and shifts the
+        positions of the remaining rows up accordingly. The freed rows are also
+        queued in 'freed_rows' in the same transaction, until the sheet has
+        deleted them (see read_freed_rows).
+        """
+        if not names:
+            # An empty read sheet is far more likely a failed read than an intent to drop every account
+            logger.warning('[SQLiteAdapter] No current accounts given, nothing deleted')
+            return []
+        try:
+            self.__cursor.execute("CREATE TEMP TABLE IF NOT EXISTS current_accounts (name TEXT PRIMARY KEY)")
+            self.__cursor.execute("DELETE FROM current_accounts")
+            self.__cursor.executemany("INSERT OR IGNORE INTO current_accounts (name) VALUES (?)", ((name,) for name in names))
+            self.__cursor.execute("SELECT sheet_row FROM transactions WHERE name NOT IN (SELECT name FROM current_accounts) AND sheet_row IS NOT NULL ORDER BY sheet_row DESC")
+            freed_rows = [row[0] for row in self.__cursor.fetchall()]
+            self.__cursor.execute("DELETE FROM transactions WHERE name NOT IN (SELECT name FROM current_accounts)")
+            deleted = self.__cursor.rowcount
+            for sheet_row in freed_rows:
+                self.__cursor.execute("UPDATE transactions SET sheet_row = sheet_row - 1 WHERE sheet_row > ?", (sheet_row,))
+            self.__cursor.executemany("INSERT INTO freed_rows (sheet_row) VALUES (?)", ((sheet_row,) for sheet_row in freed_rows))
+            self.__sqlite_conn.commit()
+            if deleted:
+                logger.info(f'[SQLiteAdapter] {deleted} removed accounts deleted')
+            return freed_rows
+        except sqlite3.Error as e:
+            self.__sqlite_conn.rollback()
+            logger.error(f'[SQLiteAdapter] An error occurred while deleting removed accounts: {e}')
+            return []
+
+    def read_freed_rows(self) -> tuple[list[int], int]:
+        """Sheet rows freed and not yet deleted from the sheet, in deletion order, and the id of the last one."""
+        self.__cursor.execute("SELECT id, sheet_row FROM freed_rows ORDER BY id")
+        records = self.__cursor.fetchall()
+        return [record[1] for record in records], records[-1][0] if records else 0
+
+    def clear_freed_rows(self, up_to_id: Optional[int] = None):
+        """Forgets freed rows the sheet has deleted (up to `up_to_id`) or no longer holds (all of them)."""
+        try:
+            if up_to_id is None:
+                self.__cursor.execute("DELETE FROM freed_rows")
             else:
-                # Insert new record
-                sql_query = "INSERT INTO transactions (name, hash, quantity, near_amount, hot_amount, age, claim_period) VALUES (?, ?, ?, ?, ?, ?, ?)"
-                self.__cursor.execute(sql_query, (name, hash, quantity, near_amount, hot_amount, age, claim_period))
-                logger.info(f'[SQLiteAdapter] Row with name {name} inserted')
-                
+                self.__cursor.execute("DELETE FROM freed_rows WHERE id <= ?", (up_to_id,))
             self.__sqlite_conn.commit()
+        except sqlite3.Error as e:
+            self.__sqlite_conn.rollback()
+            logger.error(f'[SQLiteAdapter] An error occurred while clearing freed rows: {e}')
+
+    def read_changed(self, first_row: int):
+        """Yields chunks of rows (sqlite3.Row) changed since the last sync, placing new rows after the last occupied sheet row."""
+        try:
+            self.__cursor.execute("SELECT COALESCE(MAX(sheet_row), ?) FROM transactions", (first_row - 1,))
+            last_row = self.__cursor.fetchone()[0]
+            self.__cursor.execute("SELECT id FROM transactions WHERE sheet_row IS NULL ORDER BY id")
+            new_ids = [row[0] for row in self.__cursor.fetchall()]
+            self.__cursor.executemany("UPDATE transactions SET sheet_row = ? WHERE id = ?",
+                                      ((last_row + offset, row_id) for offset, row_id in enumerate(new_ids, start=1)))
+            self.__sqlite_conn.commit()
+
+            cursor = self.__sqlite_conn.cursor()
+            cursor.execute("SELECT * FROM transactions WHERE version > synced_version ORDER BY sheet_row")
+            while len(res := cursor.fetchmany(self.db_recordset_size)) > 0:
+                logger.debug('[SQLiteAdapter] %d changed rows read', len(res))
+                yield res
         except Exception as e:
             self.__sqlite_conn.rollback()
-            logger.error(f'[SQLiteAdapter] An error occurred while upserting {name}: {e}')
+            logger.error(f'[SQLiteAdapter] An error occured while reading changed data: {e}')
+
+    def count(self) -> int:
+        self.__cursor.execute("SELECT COUNT(*) FROM transactions")
+        return self.__cursor.fetchone()[0]
+
+    def mark_synced(self, rows: Iterable[sqlite3.Row]):
+        try:
+            self.__cursor.executemany("UPDATE transactions SET synced_version = ? WHERE id = ?",
+                                      ((row['version'], row['id']) for row in rows))
+            self.__sqlite_conn.commit()
+        except sqlite3.Error as e:
+            self.__sqlite_conn.rollback()
+            logger.error(f'[SQLiteAdapter] An error occurred while marking rows as synced: {e}')
+
+    def fingerprint(self) -> tuple:
+        """Changes whenever rows are added, changed or deleted, so exports of an unchanged table can be skipped."""
+        self.__cursor.execute("SELECT COUNT(*), TOTAL(version), MAX(id) FROM transactions")
+        return tuple(self.__cursor.fetchone())
 
+    def read_export(self, columns: Iterable[str]):
+        """Yields chunks of plain tuples of `columns` for every row, in sheet order."""
+        cursor = self.__sqlite_conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(f"SELECT {', '.join(columns)} FROM transactions ORDER BY sheet_row IS NULL, sheet_row, id")
+        while chunk := cursor.fetchmany(self.db_recordset_size):
+            yield chunk
 
     def read_all(self):
         try:
@@ -84,7 +354,7 @@ class SQLiteAdapter:
             sql_query = read_sql_file(self.__schemas['read_all'])
             self.__cursor.execute(sql_query)
             while len(res := self.__cursor.fetchmany(self.db_recordset_size)) > 0:
-                logger.debug(f'[SQLiteAdapter] Data read: {res}')
-                yield [dict(row) for row in res]
+                logger.debug('[SQLiteAdapter] %d rows read', len(res))
+                yield res
         except Exception as e:
             logger.error(f'[SQLiteAdapter] An error occured while reading data: {e}')
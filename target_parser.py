@@ -1,53 +1,222 @@
-from typing import Any, Optional
+from typing import Any, Iterable, Optional
 from settings import logger
-from models import Transaction
-from utils import TimeUtils
+from models import TransactionRecord
+from utils import TimeUtils, TokenBucket, parse_retry_after
+from http_cache import CacheEntry, HttpCache
+from json_codec import JsonDecoder
+from urllib.parse import urlencode, urlparse
 import aiohttp
+import logging
 import asyncio
+import random
+import time
+import metrics
+import tracing
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RetryableStatusError(Exception):
+    def __init__(self, status: int, retry_after: Optional[float] = None):
+        super().__init__(f'Unexpected response status: {status}')
+        self.status = status
+        self.retry_after = retry_after
+
 
 class TargetParser:
-    def __init__(self, base_urls: dict[str, str], parsing_depth: int = 3):
+    def __init__(self, base_urls: dict[str, str], parsing_depth: int = 3, requests_per_second: float = 3,
+                 connection_limit: int = 10, max_retries: int = 5, backoff_base: float = 1.0,
+                 backoff_max: float = 60.0, scan_order: str = 'asc', prefetch_pages: int = 3, per_page: int = 25,
+                 api_key: Optional[str] = None, http_cache: Optional[HttpCache] = None,
+                 decoder: Optional[JsonDecoder] = None):
         self.base_urls = base_urls
+        self.__decoder = decoder or JsonDecoder()
+        self.__http_cache = http_cache
+        self.__api_key = api_key
+        self.__connection_limit = connection_limit
+        self.__session: Optional[aiohttp.ClientSession] = None
         self.__parsing_depth = parsing_depth
+        self.__requests_per_second = requests_per_second
+        self.__rate_limiters: dict[str, TokenBucket] = {}
+        self.__max_retries = max_retries
+        self.__backoff_base = backoff_base
+        self.__backoff_max = backoff_max
+        self.__scan_order = scan_order
+        self.__prefetch_pages = max(1, prefetch_pages)
+        self.__per_page = per_page
+        # Oldest-first pages are immutable once full: number of leading full pages known to hold no first MINT
+        self.__scanned_pages: dict[str, int] = {}
 
-    async def _fetch_data(self, url: str, params: Optional[dict] = None) -> dict:
-        """Общий метод для выполнения GET-запросов."""
-        logger.info(f'[TargetParser] Starting fetching. URL: {url}')
-        async with aiohttp.ClientSession() as session:
-            try:
-                async with session.get(url, params=params) as response:
-                    logger.info(f'[TargetParser] Response status: {response.status}')
-                    if response.status != 200:
-                        raise Exception(f'Unexpected response status: {response.status}')
-                    data = await response.json()
-                    logger.debug(f'[TargetParser] Data received (first 300 symbols): {str(data)[:300]}')
-                    return data
-            except aiohttp.ClientError as e:
-                logger.error(f"[TargetParser] ClientError while fetching data: {e}")
-                raise
-            except Exception as e:
-                logger.error(f"[TargetParser] Error while fetching data: {e}")
-                raise
+    async def __aenter__(self) -> 'TargetParser':
+        connector = aiohttp.TCPConnector(limit_per_host=self.__connection_limit,
+                                         ttl_dns_cache=300,
+                                         keepalive_timeout=60)
+        headers = {'Authorization': f'Bearer {self.__api_key}'} if self.__api_key else None
+        self.__session = aiohttp.ClientSession(connector=connector, headers=headers)
+        logger.info('[TargetParser] HTTP session opened')
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+            logger.info('[TargetParser] HTTP session closed')
+        if self.__http_cache is not None:
+            self.__http_cache.flush()
+
+    def _get_rate_limiter(self, url: str) -> TokenBucket:
+        """Возвращает ограничитель частоты запросов для хоста из URL."""
+        host = urlparse(url).netloc
+        if host not in self.__rate_limiters:
+            self.__rate_limiters[host] = TokenBucket(self.__requests_per_second)
+        return self.__rate_limiters[host]
+
+    def _endpoint_key(self, url: str) -> str:
+        """Возвращает ключ base_urls, к которому относится URL."""
+        matches = [key for key, base_url in self.base_urls.items() if url.startswith(base_url)]
+        return max(matches, key=lambda key: len(self.base_urls[key])) if matches else 'other'
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """Экспоненциальная задержка с полным джиттером."""
+        return random.uniform(0, min(self.__backoff_max, self.__backoff_base * 2 ** attempt))
+
+    async def _fetch_data(self, url: str, params: Optional[dict] = None, kind: Optional[str] = None) -> dict:
+        """Общий метод для выполнения GET-запросов с ограничением частоты и повторами.
+
+        `kind` — вид ответа (ключ json_codec.SCHEMAS): по нему декодируются только
+        используемые поля, и, если для него задан TTL, ответ берётся из HTTP-кэша
+        без запроса и разбора JSON.
+        """
+        if self.__session is None:
+            raise RuntimeError('TargetParser session is not opened, use "async with TargetParser(...)"')
+        with tracing.span('http', url=url, params=params, kind=kind):
+            cache = self.__http_cache if kind and self.__http_cache and self.__http_cache.enabled_for(kind) else None
+            # Paged endpoints differ only by their query parameters
+            cache_key = f'{url}?{urlencode(sorted(params.items()))}' if params else url
+            cached = cache.get(cache_key, lambda body: self.__decoder.decode(body, kind)) if cache is not None else None
+            if cached is not None and cached.fresh:
+                metrics.http_cache.inc(endpoint=kind, result='hit')
+                tracing.annotate(cache='hit')
+                return cached.data
+            rate_limiter = self._get_rate_limiter(url)
+            for attempt in range(self.__max_retries + 1):
+                await rate_limiter.acquire()
+                try:
+                    if cache is not None:
+                        return await self._cached_request(url, params, kind, cache, cache_key, cached)
+                    return await self._request(url, params, kind=kind)
+                except (RetryableStatusError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == self.__max_retries:
+                        logger.error(f'[TargetParser] Giving up on {url} after {attempt + 1} attempts: {e}')
+                        raise
+                    tracing.annotate(retries=attempt + 1)
+                    delay = self._backoff_delay(attempt)
+                    if isinstance(e, RetryableStatusError) and e.retry_after is not None:
+                        delay = max(delay, e.retry_after)
+                        rate_limiter.pause(e.retry_after)
+                    logger.warning(f'[TargetParser] Retrying {url} in {delay:.2f}s (attempt {attempt + 1}): {e}')
+                    await asyncio.sleep(delay)
+        raise RuntimeError('unreachable')
+
+    async def _cached_request(self, url: str, params: Optional[dict], kind: str, cache: HttpCache, cache_key: str,
+                              cached: Optional[CacheEntry]) -> dict:
+        """Запрос через кэш: устаревшая запись перепроверяется по ETag/Last-Modified, 304 отдаёт её без разбора JSON."""
+        headers = {}
+        if cached is not None and cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached is not None and cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+        return await self._request(url, params, headers=headers, kind=kind, cache=cache, cache_key=cache_key, cached=cached)
+
+    async def _request(self, url: str, params: Optional[dict] = None, headers: Optional[dict] = None,
+                       kind: Optional[str] = None, cache: Optional[HttpCache] = None, cache_key: Optional[str] = None,
+                       cached: Optional[CacheEntry] = None) -> dict:
+        logger.debug('[TargetParser] Starting fetching. URL: %s', url)
+        endpoint = self._endpoint_key(url)
+        status = 'error'
+        started = time.perf_counter()
+        try:
+            async with self.__session.get(url, params=params, headers=headers) as response:
+                status = str(response.status)
+                logger.debug('[TargetParser] Response status: %s', response.status)
+                if response.status == 304 and cached is not None:
+                    cache.touch(cache_key, kind, cached)
+                    metrics.http_cache.inc(endpoint=kind, result='revalidated')
+                    tracing.annotate(cache='revalidated')
+                    return cached.data
+                if response.status in RETRYABLE_STATUSES:
+                    raise RetryableStatusError(response.status, parse_retry_after(response.headers.get('Retry-After')))
+                if response.status != 200:
+                    raise Exception(f'Unexpected response status: {response.status}')
+                body = await response.read()
+                tracing.annotate(bytes=len(body))
+                data = self.__decoder.decode(body, kind)
+                if cache is not None:
+                    cache.put(cache_key, kind, data, body,
+                              response.headers.get('ETag'), response.headers.get('Last-Modified'))
+                    metrics.http_cache.inc(endpoint=kind, result='miss')
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('[TargetParser] Data received (first 300 bytes): %s', body[:300])
+                return data
+        except RetryableStatusError:
+            raise
+        except aiohttp.ClientError as e:
+            logger.error(f"[TargetParser] ClientError while fetching data: {e}")
+            raise
+        except Exception as e:
+            logger.error(f"[TargetParser] Error while fetching data: {e}")
+            raise
+        finally:
+            metrics.http_requests.inc(endpoint=endpoint, status=status)
+            latency = time.perf_counter() - started
+            metrics.http_request_duration.observe(latency, endpoint=endpoint)
+            tracing.annotate(endpoint=endpoint, status=status, latency=latency)
 
     async def fetch_txns_data(self, query_params: dict[str, Any]) -> dict[str, Any]:
-        return await self._fetch_data(self.base_urls['txns'], query_params)
+        return await self._fetch_data(self.base_urls['txns'], query_params, kind='txns')
+
+    async def fetch_txns_count(self, query_params: dict[str, Any]) -> int:
+        data = await self._fetch_data(f"{self.base_urls['txns']}/count", query_params, kind='txns_count')
+        return int(data['txns'][0]['count'])
+
+    async def fetch_feed_events(self, since: Optional[str], max_pages: int, per_page: int = 100) -> tuple[list[dict[str, Any]], Optional[str], bool]:
+        """Читает общую ленту транзакций контракта от новых событий к старым, до события `since` (event_index).
+
+        Возвращает события новее `since`, event_index самого нового события (новый курсор)
+        и признак того, что лента прочитана до `since` целиком. Без `since` читается
+        только первая страница, чтобы узнать курсор.
+        """
+        events = []
+        head = since
+        for page in range(1, max_pages + 1):
+            data = await self.fetch_txns_data({'page': page, 'per_page': per_page, 'order': 'desc'})
+            txns = data['txns']
+            if page == 1 and txns:
+                head = txns[0]['event_index']
+            if since is None:
+                return events, head, False
+            for txn in txns:
+                if int(txn['event_index']) <= int(since):
+                    return events, head, True
+                events.append(txn)
+            if len(txns) < per_page:
+                return events, head, True
+        logger.warning(f'[TargetParser] Feed has more than {max_pages} pages of new events')
+        return events, head, False
 
     async def fetch_txn_data(self, txn_hash: str, params: dict[str, str]) -> bool:
         url = f"{self.base_urls['txn']}/{txn_hash}"
-        data = await self._fetch_data(url)
+        with tracing.span('txn_check', hash=txn_hash):
+            data = await self._fetch_data(url, kind='txn')
         fts = self._extract_fts(data)
         return bool(fts and fts[0].get('affected_account_id') == params['affected_account_id'])
 
     async def fetch_account_data(self, query_params: dict[str, Any]) -> dict[str, Any]:
         account = query_params['account']
         contract_name = query_params['contract_name']
-        urls = [
-            f"{self.base_urls['account']}/{account}",
-            f"{self.base_urls['account']}/{account}/inventory"
-        ]
-        
-        results = await asyncio.gather(*[self._fetch_data(url) for url in urls])
-        account_data, inventory_data = results
+        account_data, inventory_data = await asyncio.gather(
+            self._fetch_data(f"{self.base_urls['account']}/{account}", kind='account'),
+            self._fetch_data(f"{self.base_urls['account']}/{account}/inventory", kind='inventory'))
 
         near_amount = account_data['account'][0]['amount']
         hot_amount = self._extract_hot_amount(inventory_data, contract_name)
@@ -71,37 +240,127 @@ class TargetParser:
                 return ft['amount']
         return None
 
-    async def parse(self, query_params: dict[str, Any]) -> dict[str, Any]:
+    async def parse(self, query_params: dict[str, Any], known_txn: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+        """Ищет первое MINT-поступление аккаунта.
+
+        Если первое поступление уже известно (`known_txn`), страницы транзакций
+        не запрашиваются: догружаются только данные аккаунта.
+        Ошибки запросов не маскируются пустой строкой: они пробрасываются,
+        чтобы аккаунт не был записан так, будто MINT-транзакции у него нет.
+        """
         try:
-            for page in range(1, self.__parsing_depth + 1):
-                query_params['page'] = page
-                data = await self.fetch_txns_data(query_params)
-                for txn in data['txns']:
+            if known_txn is not None:
+                logger.debug('[TargetParser] First entrance taken from cache: %s', known_txn)
+                txn = await self._with_account_data(dict(known_txn), query_params)
+                metrics.parse_outcomes.inc(outcome='found')
+                tracing.annotate(outcome='found', known_mint=True)
+                return txn
+            with tracing.span('scan_pages'):
+                txn = await self._scan_pages(query_params)
+            if txn is not None:
+                txn = await self._with_account_data(txn, query_params)
+                metrics.parse_outcomes.inc(outcome='found')
+                tracing.annotate(outcome='found')
+                return txn
+            metrics.parse_outcomes.inc(outcome='not_found')
+            tracing.annotate(outcome='not_found')
+            return {'affected_account_id': query_params['a']}
+        except Exception as e:
+            metrics.parse_outcomes.inc(outcome='error')
+            logger.error(f'[TargetParser] An error occurred while parsing {query_params["a"]}: {e}')
+            raise
+
+    async def _page_plan(self, query_params: dict[str, Any]) -> list[int]:
+        """Номера страниц для просмотра, от самых старых транзакций к новым, не больше parsing_depth."""
+        if self.__scan_order == 'asc':
+            first_page = self.__scanned_pages.get(query_params['a'], 0) + 1
+            return list(range(first_page, first_page + self.__parsing_depth))
+        # При сортировке от новых к старым самые старые транзакции на последней странице
+        count = await self.fetch_txns_count({'a': query_params['a']})
+        last_page = max(1, -(-count // self.__per_page))
+        return list(range(last_page, max(0, last_page - self.__parsing_depth), -1))
+
+    async def _scan_pages(self, query_params: dict[str, Any]) -> Optional[dict[str, Any]]:
+        """Просматривает страницы от самых старых транзакций.
+
+        Первая страница запрашивается отдельно, так как обычно первое поступление
+        уже на ней; дальше страницы запрашиваются окнами по prefetch_pages параллельно.
+        """
+        account = query_params['a']
+        pages = await self._page_plan(query_params)
+        start = 0
+        while start < len(pages):
+            window = pages[start:start + (self.__prefetch_pages if start else 1)]
+            start += len(window)
+            results = await asyncio.gather(*[
+                self.fetch_txns_data({**query_params, 'page': page, 'per_page': self.__per_page, 'order': self.__scan_order})
+                for page in window
+            ])
+            for page, data in zip(window, results):
+                txns = data['txns'] if self.__scan_order == 'asc' else data['txns'][::-1]
+                for txn in txns:
                     if txn['cause'] == 'MINT' and txn['involved_account_id'] is None:
-                        logger.debug(f'[TargetParser] First entrance found: {txn}')
+                        logger.debug('[TargetParser] First entrance found: %s', txn)
                         if await self.fetch_txn_data(txn['transaction_hash'], txn):
-                            account_data = await self.fetch_account_data({
-                                'account': query_params['a'],
-                                'contract_name': query_params.get('contract_name')
-                            })
-                            txn.update(account_data)
                             return txn
-            return {'affected_account_id': query_params['a']}
-        except Exception as e:
-            logger.error(f'[TargetParser] An error occurred while parsing: {e}')
-            return {'affected_account_id': query_params['a']}
+                if self.__scan_order == 'asc':
+                    if len(txns) < self.__per_page:
+                        return None  # Reached the newest transactions
+                    if page == self.__scanned_pages.get(account, 0) + 1:
+                        self.__scanned_pages[account] = page
+                elif page == 1:
+                    return None
+        return None
+
+    async def _with_account_data(self, txn: dict[str, Any], query_params: dict[str, Any]) -> dict[str, Any]:
+        with tracing.span('account_data'):
+            account_data = await self.fetch_account_data({
+                'account': query_params['a'],
+                'contract_name': query_params.get('contract_name')
+            })
+        txn.update(account_data)
+        return txn
 
-    def serialize(self, txn: dict[str, Any]) -> Transaction:
-        logger.info('[TargetParser] Starting serialization')
-        transaction = Transaction(
-            hash=txn.get('transaction_hash'),
-            name=txn['affected_account_id'],
-            quantity=int(txn['delta_amount'])/10e5 if txn.get('delta_amount') is not None else None,
-            age=TimeUtils.ns_delta_to_hours(int(txn['block_timestamp'])) if txn.get('block_timestamp') is not None else None,
-            near_amount=int(txn['near_amount'])/10e24 if txn.get('near_amount') is not None else None,
-            hot_amount=int(txn['hot_amount'])/10e5 if txn.get('hot_amount') is not None else None,
-            claim_period=int(txn['claim_period']) if txn.get('claim_period') and txn['claim_period'] != '' else None,
-
-        )
-        logger.debug(f'[TargetParser] Serialization successful: {transaction.model_dump()}')
-        return transaction
\ No newline at end of file
+    def serialize_many(self, txns: Iterable[dict[str, Any]], now: Optional[float] = None,
+                       failed: Optional[dict[str, str]] = None) -> list[TransactionRecord]:
+        """Преобразует разобранные транзакции в записи для SQLite и листа за один проход.
+
+        Возраст считается относительно одного момента `now` (Unix time) для всей пачки.
+        Нечисловой claim_period записывается как NULL. Транзакции, которые не удалось
+        преобразовать, пропускаются с ошибкой в логе, а их аккаунты с текстом ошибки
+        добавляются в `failed`.
+        """
+        if now is None:
+            now = time.time()
+        records = []
+        for txn in txns:
+            try:
+                delta_amount = txn.get('delta_amount')
+                block_timestamp = txn.get('block_timestamp')
+                near_amount = txn.get('near_amount')
+                hot_amount = txn.get('hot_amount')
+                claim_period = _to_int(txn.get('claim_period'))
+                records.append(TransactionRecord(
+                    txn['affected_account_id'],
+                    txn.get('transaction_hash'),
+                    int(delta_amount) / 10e5 if delta_amount is not None else None,
+                    int(near_amount) / 10e24 if near_amount is not None else None,
+                    int(hot_amount) / 10e5 if hot_amount is not None else None,
+                    TimeUtils.ns_delta_to_hours(int(block_timestamp), now) if block_timestamp is not None else None,
+                    claim_period,
+                ))
+            except Exception as e:
+                logger.error(f'[TargetParser] An error occurred while serializing {txn.get("affected_account_id")}: {e}')
+                if failed is not None and txn.get('affected_account_id'):
+                    failed[txn['affected_account_id']] = f'Serialization failed: {e}'
+        logger.debug('[TargetParser] %d transactions serialized', len(records))
+        return records
+
+
+def _to_int(value: Any) -> Optional[int]:
+    """claim_period из листа чтения; пустое или нечисловое значение — None."""
+    try:
+        return int(value) if value else None
+    except (TypeError, ValueError):
+        logger.warning(f'[TargetParser] claim_period {value!r} is not a number, stored as NULL')
+        return None
@@ -0,0 +1,191 @@
+"""Opt-in span tracing and cycle profiling of the parse path.
+
+With tracing configured every traced account gets a span tree: the parse, its
+page scan, txn check and account lookups, and below them each HTTP call with
+its base_urls key, status, size and latency. Serialization, SQLite writes and
+publishes are traced per batch. Spans are buffered and written to a JSONL file
+(path ending in .jsonl) or to a 'spans' table of an SQLite file (any other
+path). Unconfigured, every hook is a shared no-op context manager.
+"""
+import atexit
+import contextlib
+import itertools
+import json
+import os
+import sqlite3
+import time
+from contextvars import ContextVar
+from typing import Any, Iterable, Optional
+from settings import logger
+
+_current: ContextVar[Optional['Span']] = ContextVar('trace_span', default=None)
+_ids = itertools.count(1)
+_NULL = contextlib.nullcontext()
+_writer: Optional['TraceWriter'] = None
+_accounts: Optional[frozenset[str]] = None
+
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attrs', 'started_at', 'duration', '__start', '__token')
+
+    def __init__(self, name: str, parent: Optional['Span'], attrs: dict[str, Any]):
+        self.span_id = next(_ids)
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self.parent_id = parent.span_id if parent is not None else None
+        self.name = name
+        self.attrs = attrs
+        self.started_at = 0.0
+        self.duration = 0.0
+
+    def __enter__(self) -> 'Span':
+        self.started_at = time.time()
+        self.__start = time.perf_counter()
+        self.__token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.__start
+        _current.reset(self.__token)
+        if exc is not None:
+            self.attrs['error'] = f'{exc_type.__name__}: {exc}'
+        if _writer is not None:
+            _writer.write(self)
+
+
+class TraceWriter:
+    """Buffers finished spans and appends them to `path` every `flush_every` spans and on flush()."""
+    def __init__(self, path: str, flush_every: int = 1000):
+        self.path = path
+        self.flush_every = flush_every
+        self.__buffer: list[tuple] = []
+        self.__conn: Optional[sqlite3.Connection] = None
+        if not path.endswith('.jsonl'):
+            self.__conn = sqlite3.connect(path)
+            self.__conn.execute('PRAGMA journal_mode=WAL')
+            self.__conn.execute("""CREATE TABLE IF NOT EXISTS spans (
+                trace_id INTEGER NOT NULL,
+                span_id INTEGER NOT NULL,
+                parent_id INTEGER,
+                pid INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                started_at REAL NOT NULL,
+                duration REAL NOT NULL,
+                attrs TEXT
+            )""")
+            self.__conn.execute("CREATE INDEX IF NOT EXISTS spans_trace ON spans (pid, trace_id)")
+            self.__conn.commit()
+
+    def write(self, span: Span):
+        self.__buffer.append((span.trace_id, span.span_id, span.parent_id, os.getpid(), span.name,
+                              span.started_at, span.duration, json.dumps(span.attrs, default=str)))
+        if len(self.__buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self.__buffer:
+            return
+        buffer, self.__buffer = self.__buffer, []
+        try:
+            if self.__conn is not None:
+                self.__conn.executemany("INSERT INTO spans (trace_id, span_id, parent_id, pid, name, started_at, duration, attrs) "
+                                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", buffer)
+                self.__conn.commit()
+            else:
+                with open(self.path, 'a', encoding='utf-8') as file:
+                    for trace_id, span_id, parent_id, pid, name, started_at, duration, attrs in buffer:
+                        file.write(f'{{"trace_id": {trace_id}, "span_id": {span_id}, "parent_id": {json.dumps(parent_id)}, '
+                                   f'"pid": {pid}, "name": {json.dumps(name)}, "started_at": {started_at}, '
+                                   f'"duration": {duration}, "attrs": {attrs}}}\n')
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f'[Tracing] An error occurred while writing {len(buffer)} spans to {self.path}: {e}')
+
+    def close(self):
+        self.flush()
+        if self.__conn is not None:
+            self.__conn.close()
+            self.__conn = None
+
+
+def configure(path: str, accounts: Iterable[str] = ()):
+    """Starts writing spans to `path`; with `accounts` only those accounts are traced."""
+    global _writer, _accounts
+    if _writer is not None:
+        _writer.close()
+    _writer = TraceWriter(path)
+    _accounts = frozenset(accounts) or None
+    atexit.register(_writer.close)
+    logger.info(f'[Tracing] Writing spans to {path}')
+
+
+def flush():
+    if _writer is not None:
+        _writer.flush()
+
+
+def root(name: str, **attrs):
+    """Starts a new trace, e.g. for a batch of the pipeline."""
+    if _writer is None:
+        return _NULL
+    return Span(name, None, attrs)
+
+
+def account(name: str):
+    """Starts the trace of one account, if it is traced."""
+    if _writer is None or (_accounts is not None and name not in _accounts):
+        return _NULL
+    return Span('account', None, {'account': name})
+
+
+def span(name: str, **attrs):
+    """Child of the current span; nothing is recorded outside a trace."""
+    parent = _current.get()
+    if parent is None:
+        return _NULL
+    return Span(name, parent, attrs)
+
+
+def annotate(**attrs):
+    """Adds attributes to the current span."""
+    current = _current.get()
+    if current is not None:
+        current.attrs.update(attrs)
+
+
+class CycleProfiler:
+    """Runs cycles under cProfile or yappi and dumps pstats files to `directory`, one per cycle.
+
+    yappi measures wall time per coroutine, which cProfile cannot attribute
+    across awaits; it has to be installed separately.
+    """
+    def __init__(self, backend: str, directory: str):
+        if backend not in ('cprofile', 'yappi'):
+            raise ValueError(f'Unknown profiler: {backend}')
+        self.backend = backend
+        self.directory = directory
+        # Numbers the dumps, as several cycles may run within the same second
+        self.__runs = itertools.count(1)
+        os.makedirs(directory, exist_ok=True)
+
+    @contextlib.contextmanager
+    def profile(self, label: str = 'cycle'):
+        path = os.path.join(self.directory, f'{label}-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}-{next(self.__runs)}.pstats')
+        if self.backend == 'yappi':
+            import yappi
+            yappi.set_clock_type('wall')
+            yappi.clear_stats()
+            yappi.start()
+            try:
+                yield
+            finally:
+                yappi.stop()
+                yappi.get_func_stats().save(path, type='pstat')
+        else:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(path)
+        logger.info(f'[Profiler] {self.backend} stats saved to {path}')
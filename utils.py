@@ -1,13 +1,22 @@
+import asyncio
+import os
 import sqlite3
+import time
+import zlib
 from settings import logger
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
 
 @contextmanager
-def sqlite_conn_context(db_path):
+def sqlite_conn_context(db_path, synchronous='NORMAL'):
     try:
         sqlite_conn = sqlite3.connect(db_path)
         sqlite_conn.row_factory = sqlite3.Row 
+        # WAL lets readers run alongside the batch writer; NORMAL syncs only on checkpoints
+        sqlite_conn.execute('PRAGMA journal_mode=WAL')
+        sqlite_conn.execute(f'PRAGMA synchronous={synchronous}')
         yield sqlite_conn
     except Exception as err:
         logger.error(f'SQLite connection context manager caught an error: {err}')
@@ -15,6 +24,17 @@ def sqlite_conn_context(db_path):
         sqlite_conn.close()
 
 
+def shard_of(name: str, shard_count: int) -> int:
+    """Stable shard number of an account, the same in every process and on every host."""
+    return zlib.crc32(name.encode()) % shard_count
+
+
+def shard_path(path: str, index: int) -> str:
+    """SQLite file of a shard, e.g. data.db -> data.shard0.db."""
+    root, ext = os.path.splitext(path)
+    return f'{root}.shard{index}{ext}'
+
+
 def read_sql_file(file_path):
     with open(file_path, 'r') as file:
         sql_query = file.read()
@@ -23,8 +43,59 @@ def read_sql_file(file_path):
 
 class TimeUtils:
     @staticmethod
-    def ns_delta_to_hours(ns: int) -> int:
-        delta_time = datetime.now() - datetime.fromtimestamp(ns / 1e9)
-        total_seconds = delta_time.total_seconds()
-        hours = total_seconds // 3600
-        return round(hours) 
+    def ns_delta_to_hours(ns: int, now: Optional[float] = None) -> int:
+        """Whole hours from the nanosecond timestamp `ns` to `now` (Unix time, the current time by default)."""
+        if now is None:
+            now = time.time()
+        return int((now - ns / 1e9) // 3600)
+
+
+class TokenBucket:
+    """Token bucket: allows bursts of up to `capacity` calls and refills at `rate` tokens per second."""
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.__tokens = self.capacity
+        self.__updated: Optional[float] = None
+        self.__blocked_until = 0.0
+        self.__lock = asyncio.Lock()
+
+    def __refill(self, now: float):
+        if self.__updated is not None:
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        async with self.__lock:
+            while True:
+                now = loop.time()
+                self.__refill(now)
+                delay = self.__blocked_until - now
+                if delay <= 0 and self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                await asyncio.sleep(max(delay, (1 - self.__tokens) / self.rate))
+
+    def pause(self, seconds: float):
+        """Blocks the bucket for `seconds`, e.g. when the server answered with Retry-After."""
+        now = asyncio.get_running_loop().time()
+        self.__blocked_until = max(self.__blocked_until, now + seconds)
+        self.__tokens = 0
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parses a Retry-After header given either in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())